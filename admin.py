@@ -1,23 +1,109 @@
-from django.contrib import admin
+import json
+from django.conf.urls import patterns, url
+from django.contrib import admin, messages
+from django.forms.models import BaseInlineFormSet
+from django.http import HttpResponse, HttpResponseNotAllowed, HttpResponseRedirect
+from django.shortcuts import get_object_or_404
 
 
-from distributed.models import DistributedSource, DistributedSourceModel
+from distributed.models import DistributedSource, DistributedSourceModel, SyncRun, SyncModelRun
 
 
 class DistributedSourceModelInline(admin.TabularInline):
     model = DistributedSourceModel
-    fields = ('resource_name', 'api_url', 'order', 'active', 'last_sync', 'last_sync_message')
-    readonly_fields = ('last_sync','last_sync_message',)
+    fields = ('resource_name', 'api_url', 'active', 'shards', 'last_sync', 'last_sync_message', 'last_run')
+    readonly_fields = ('last_sync','last_sync_message', 'last_run')
     extra = 0
 
+    def last_run(self, obj):
+        model_run = obj.runs.first() if obj.pk else None
+        return model_run.summary() if model_run else ''
+
+
+
+class RecentSyncRunFormSet(BaseInlineFormSet):
+    """ Only the 10 latest runs of the source """
+    def get_queryset(self):
+        if not hasattr(self, '_queryset'):
+            self._queryset = super(RecentSyncRunFormSet, self).get_queryset()[:10]
+        return self._queryset
+
+
+
+class SyncRunInline(admin.TabularInline):
+    model = SyncRun
+    formset = RecentSyncRunFormSet
+    fields = ('started', 'finished', 'status', 'message')
+    readonly_fields = ('started', 'finished', 'status', 'message')
+    extra = 0
+    max_num = 0
+    can_delete = False
+
 
 
 class DistributedSourceAdmin(admin.ModelAdmin):
-    fields = ('name','active', 'api_url','last_sync', 'api_username','api_password', 'notes','last_sync_message')
-    readonly_fields = ('last_sync','last_sync_message',)
-    inlines = [DistributedSourceModelInline,]
+    fields = ('name','active', 'api_url','last_sync', 'api_username','api_password', 'notes','last_sync_message',
+              'sync_interval', 'next_sync', 'failure_count', 'push_url', 'push_secret')
+    readonly_fields = ('last_sync','last_sync_message', 'next_sync', 'failure_count')
+    inlines = [DistributedSourceModelInline, SyncRunInline,]
+    actions = ['sync_now']
+    change_form_template = 'admin/distributed/distributedsource/change_form.html'
+
+    def get_urls(self):
+        info = self.model._meta.app_label, self.model._meta.model_name
+        return patterns('',
+            url(r'^(\d+)/sync/$', self.admin_site.admin_view(self.sync_view), name='%s_%s_sync' % info),
+            url(r'^(\d+)/progress/$', self.admin_site.admin_view(self.progress_view), name='%s_%s_progress' % info),
+        ) + super(DistributedSourceAdmin, self).get_urls()
 
     def save_related(self, request, form, formsets, change):
         super(DistributedSourceAdmin, self).save_related(request, form, formsets, change)
-        form.instance.sync()
+        # in the background, the request doesn't wait for the peer
+        form.instance.queue_sync()
+
+    def sync_now(self, request, queryset):
+        for source in queryset:
+            source.queue_sync()
+        self.message_user(request, 'Queued a sync of %d sources' % len(queryset))
+    sync_now.short_description = 'Sync the selected sources now'
+
+    def sync_view(self, request, object_id):
+        """ Queue a sync of the source (POST) and return to its change page """
+        if request.method != 'POST':
+            return HttpResponseNotAllowed(['POST'])
+        source = get_object_or_404(DistributedSource, pk=object_id)
+        if not self.has_change_permission(request, source):
+            return HttpResponseRedirect('../')
+        source.queue_sync()
+        messages.info(request, 'Queued a sync of %s' % source)
+        return HttpResponseRedirect('../')
+
+    def progress_view(self, request, object_id):
+        """ JSON progress of the latest sync of the source, polled by the change page """
+        source = get_object_or_404(DistributedSource, pk=object_id)
+        run = source.runs.filter(status='running').first() or source.runs.filter(status='queued').first() or \
+              source.runs.exclude(status='queued').first()
+        data = run.progress() if run else None
+        return HttpResponse(json.dumps(data), content_type='application/json')
 admin.site.register(DistributedSource, DistributedSourceAdmin)
+
+
+
+class SyncModelRunInline(admin.TabularInline):
+    model = SyncModelRun
+    fields = ('source_model', 'message', 'records_seen', 'records_inserted', 'records_updated', 'records_skipped',
+              'fetch_time', 'parse_time', 'resolve_time', 'write_time', 'bytes_transferred', 'query_count', 'query_time')
+    readonly_fields = fields
+    extra = 0
+    max_num = 0
+    can_delete = False
+
+
+
+class SyncRunAdmin(admin.ModelAdmin):
+    list_display = ('source', 'started', 'finished', 'status', 'message')
+    list_filter = ('status', 'source')
+    readonly_fields = ('source', 'queued', 'started', 'finished', 'status', 'message', 'full',
+                       'models_total', 'models_done', 'records_processed')
+    inlines = [SyncModelRunInline,]
+admin.site.register(SyncRun, SyncRunAdmin)
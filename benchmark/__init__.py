@@ -0,0 +1,4 @@
+"""
+Sync benchmark - add 'distributed.benchmark' to INSTALLED_APPS, create its tables
+with syncdb and run: manage.py sync_benchmark --help
+"""
@@ -0,0 +1,85 @@
+import resource
+import time
+from optparse import make_option
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection
+
+from distributed.benchmark.models import BenchmarkParent, BenchmarkRecord
+from distributed.benchmark.peer import PeerConfig, start_peer
+from distributed.models import DistributedSource
+
+
+FIELDS = ('decimal', 'date', 'datetime', 'fk')
+
+
+class Command(BaseCommand):
+    args = ''
+    help = 'Benchmark DistributedSource.sync() against a local stand-in peer with synthetic data'
+    option_list = BaseCommand.option_list + (
+        make_option('--rows', type='int', dest='rows', default=100000,
+            help='Number of benchmark_record rows'),
+        make_option('--fanout', type='int', dest='fanout', default=10,
+            help='benchmark_record rows per benchmark_parent row'),
+        make_option('--change-rate', type='float', dest='change_rate', default=0.01,
+            help='Fraction of rows changed for the incremental scenario'),
+        make_option('--fields', dest='fields', default=','.join(FIELDS),
+            help='Comma separated field mix out of %s' % ', '.join(FIELDS)),
+        make_option('--page-size', type='int', dest='page_size', default=1000,
+            help='Records per page served by the peer'),
+        make_option('--port', type='int', dest='port', default=8765,
+            help='Port for the stand-in peer'),
+    )
+
+    def handle(self, *args, **options):
+        fields = tuple(field for field in options['fields'].split(',') if field)
+        if set(fields) - set(FIELDS):
+            raise CommandError('Unknown fields: %s' % ', '.join(set(fields) - set(FIELDS)))
+        config = PeerConfig(options['rows'], options['fanout'], options['change_rate'], fields, options['page_size'])
+        # the resources are only known to the benchmark
+        settings.DISTRIBUTED_MODELS = dict(getattr(settings, 'DISTRIBUTED_MODELS', {}),
+            benchmark_parent='benchmark.BenchmarkParent', benchmark_record='benchmark.BenchmarkRecord')
+
+        self.reset()
+        peer = start_peer(config, options['port'])
+        try:
+            time.sleep(0.5)
+            source = DistributedSource.objects.create(name='benchmark', api_url='http://127.0.0.1:%d/v1/' % options['port'])
+            # first sync registers the resources
+            source.sync()
+            source.models.update(active=True)
+            self.stdout.write('%s, %d rows, fanout %d, change rate %s, fields %s' % (
+                connection.vendor, options['rows'], options['fanout'], options['change_rate'], ','.join(fields)))
+            self.stdout.write('%-12s %-18s %9s %9s %9s %9s %8s %9s %10s' % (
+                'scenario', 'resource', 'seen', 'written', 'seconds', 'rows/sec', 'queries', 'KB', 'peak RSS'))
+            self.run(source, 'full', full=True)
+            source.api_url = source.api_url.replace('/v1/', '/v2/')
+            source.save()
+            self.run(source, 'incremental')
+            self.run(source, 'unchanged')
+            source.delete()
+        finally:
+            peer.terminate()
+            self.reset()
+
+    def reset(self):
+        DistributedSource.objects.filter(name='benchmark').delete()
+        BenchmarkRecord.objects.all_with_deleted().delete()
+        BenchmarkParent.objects.all_with_deleted().delete()
+
+    def run(self, source, scenario, full=False):
+        source.sync(full=full)
+        run = source.runs.first()
+        if run.status != 'success':
+            raise CommandError('%s sync failed: %s' % (scenario, run.message))
+        for model_run in run.model_runs.order_by('started'):
+            seconds = (model_run.finished - model_run.started).total_seconds()
+            self.stdout.write('%-12s %-18s %9d %9d %9.2f %9.0f %8d %9d %8d MB' % (
+                scenario, model_run.source_model.resource_name, model_run.records_seen,
+                model_run.records_inserted + model_run.records_updated, seconds,
+                model_run.records_seen / seconds if seconds else 0, model_run.query_count,
+                model_run.bytes_transferred / 1024,
+                # kilobytes on Linux - this is the peak for the process so far
+                resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024))
+        for model_run in run.model_runs.exclude(message__startswith='Synced'):
+            raise CommandError('%s sync of %s failed: %s' % (scenario, model_run.source_model, model_run.message))
@@ -0,0 +1,24 @@
+from django.db import models
+
+from distributed.models import DistributedMixin
+
+
+class BenchmarkParent(DistributedMixin):
+    """
+    Synthetic resource referred to by BenchmarkRecord
+    """
+    name                      = models.CharField(max_length=100,      null=False, blank=False)
+    modified_date             = models.DateTimeField(                 null=True,  editable=False)
+
+
+
+class BenchmarkRecord(DistributedMixin):
+    """
+    Synthetic resource with a decimal, date, datetime and foreign key field
+    """
+    parent                    = models.ForeignKey(BenchmarkParent,    null=True,  blank=True,   related_name='records')
+    name                      = models.CharField(max_length=100,      null=False, blank=False)
+    amount                    = models.DecimalField(max_digits=12, decimal_places=2, null=True, blank=True)
+    day                       = models.DateField(                     null=True,  blank=True)
+    moment                    = models.DateTimeField(                 null=True,  blank=True)
+    modified_date             = models.DateTimeField(                 null=True,  editable=False)
@@ -0,0 +1,134 @@
+"""
+Stand-in peer serving synthetic resources over HTTP, in a separate process so it doesn't
+share memory or the GIL with the sync being measured.
+
+Rows are computed from their index, nothing is held in memory. Data set version 1 is the
+initial load; in version 2 one row in every 1 / change_rate has a newer modified_date and
+name. Urls: /v<version>/ (resource index) and /v<version>/<resource>/ with the
+modified_since, after_uuid and start (page cursor) query parameters.
+"""
+import json
+import multiprocessing
+import urllib
+import urlparse
+import uuid
+from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+from SocketServer import ThreadingMixIn
+from datetime import datetime, timedelta
+from decimal import Decimal
+
+
+BASE_DATE = datetime(2014, 1, 1)
+CHANGE_DATE = datetime(2020, 1, 1)
+RESOURCES = ('benchmark_parent', 'benchmark_record')
+
+
+
+class PeerConfig(object):
+    def __init__(self, rows, fanout=10, change_rate=0.01, fields=('decimal', 'date', 'datetime', 'fk'), page_size=1000):
+        self.rows = rows
+        self.parents = max(1, rows // max(1, fanout))
+        self.change_every = int(round(1 / change_rate)) if change_rate else 0
+        self.fields = fields
+        self.page_size = page_size
+
+    def count(self, resource):
+        return self.parents if resource == 'benchmark_parent' else self.rows
+
+    def uuid(self, resource, i):
+        # uuids and modified dates both increase with i, so index order is (modified_date, uuid) order
+        return uuid.UUID(int=(RESOURCES.index(resource) + 1) << 64 | i).hex
+
+    def changed(self, version, i):
+        return version > 1 and self.change_every and i % self.change_every == 0
+
+    def modified_date(self, version, i):
+        return (CHANGE_DATE if self.changed(version, i) else BASE_DATE) + timedelta(seconds=i)
+
+    def row(self, resource, version, i):
+        rec = {
+            'uuid': self.uuid(resource, i),
+            'name': '%s %d%s' % (resource, i, ' changed' if self.changed(version, i) else ''),
+            'modified_date': self.modified_date(version, i).isoformat() + 'Z',
+        }
+        if resource == 'benchmark_record':
+            if 'decimal' in self.fields:
+                rec['amount'] = str(Decimal(i % 100000) / 100)
+            if 'date' in self.fields:
+                rec['day'] = (BASE_DATE + timedelta(days=i % 3650)).date().isoformat()
+            if 'datetime' in self.fields:
+                rec['moment'] = (BASE_DATE + timedelta(minutes=i)).isoformat()
+            if 'fk' in self.fields:
+                rec['parent'] = self.uuid('benchmark_parent', i % self.parents)
+        return rec
+
+    def page(self, resource, version, query):
+        """ Rows newer than modified_since / after_uuid from index start on, and the next start """
+        since = query.get('modified_since')
+        after = query.get('after_uuid', '')
+        if since:
+            since = datetime.strptime(since[:19], '%Y-%m-%dT%H:%M:%S')
+        rows, i, count = [], int(query.get('start', 0)), self.count(resource)
+        while i < count and len(rows) < self.page_size:
+            if since:
+                key = (self.modified_date(version, i), self.uuid(resource, i))
+                if key <= (since, after):
+                    i += 1
+                    continue
+            rows.append(self.row(resource, version, i))
+            i += 1
+        return rows, (i if i < count else None)
+
+
+
+class PeerHandler(BaseHTTPRequestHandler):
+    config = None
+
+    def log_message(self, *args):
+        pass
+
+    def do_GET(self):
+        url = urlparse.urlparse(self.path)
+        parts = [part for part in url.path.split('/') if part]
+        if not parts or not parts[0].startswith('v'):
+            return self.send_error(404)
+        version = int(parts[0][1:])
+        if len(parts) == 1:
+            body = dict((resource, resource) for resource in RESOURCES)
+        elif parts[1] in RESOURCES:
+            query = dict(urlparse.parse_qsl(url.query))
+            rows, start = self.config.page(parts[1], version, query)
+            next_url = None
+            if start is not None:
+                query['start'] = start
+                next_url = 'http://%s:%d%s?%s' % (self.server.server_name, self.server.server_port,
+                                                  url.path, urllib.urlencode(query))
+            body = {'results': rows, 'next': next_url}
+        else:
+            return self.send_error(404)
+        data = json.dumps(body)
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+
+
+class ThreadingHTTPServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+
+
+def serve(config, port):
+    PeerHandler.config = config
+    ThreadingHTTPServer(('127.0.0.1', port), PeerHandler).serve_forever()
+
+
+
+def start_peer(config, port):
+    """ Start the peer in a child process, returns the process - terminate() it when done """
+    process = multiprocessing.Process(target=serve, args=(config, port))
+    process.daemon = True
+    process.start()
+    return process
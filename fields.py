@@ -1,6 +1,7 @@
 import uuid
 from django import forms
-from django.db.models import Field, SubfieldBase
+from django.db import connection
+from django.db.models import Field
 from django.utils.encoding import smart_unicode
 
 try:
@@ -18,10 +19,16 @@ except (ImportError, AttributeError):
 
 
 class StringUUID(uuid.UUID):
-    def __init__(self, *args, **kwargs):
-        # get around UUID's immutable setter
-        object.__setattr__(self, 'hyphenate', kwargs.pop('hyphenate', False))
+    # class level instead of per instance - StringUUID(..., hyphenate=True) returns a HyphenatedStringUUID
+    hyphenate = False
+
+    def __new__(cls, *args, **kwargs):
+        if kwargs.get('hyphenate') and not cls.hyphenate:
+            cls = HyphenatedStringUUID
+        return uuid.UUID.__new__(cls)
 
+    def __init__(self, *args, **kwargs):
+        kwargs.pop('hyphenate', None)
         super(StringUUID, self).__init__(*args, **kwargs)
 
     def __unicode__(self):
@@ -37,22 +44,48 @@ class StringUUID(uuid.UUID):
         return len(self.__unicode__())
 
 
+class HyphenatedStringUUID(StringUUID):
+    hyphenate = True
+
+
+class UUIDDescriptor(object):
+    """
+    Converts the database value to a StringUUID when the attribute is first read, instead
+    of on every row loaded like SubfieldBase does.
+    """
+    def __init__(self, field):
+        self.field = field
+
+    def __get__(self, instance, owner):
+        if instance is None:
+            return self
+        value = instance.__dict__.get(self.field.attname)
+        if value is not None and not isinstance(value, StringUUID):
+            value = instance.__dict__[self.field.attname] = self.field.to_python(value)
+        return value
+
+    def __set__(self, instance, value):
+        instance.__dict__[self.field.attname] = value
+
+
 class UUIDField(Field):
     """
     A field which stores a UUID value in hex format. This may also have
     the Boolean attribute 'auto' which will set the value on initial save to a
     new UUID value (calculated using the UUID1 method). Note that while all
     UUIDs are expected to be unique we enforce this with a DB constraint.
+
+    Postgres always gets its native uuid type. With binary=True other databases
+    store the 16 raw bytes instead of 32 hex characters.
     """
-    # TODO: support binary storage types
-    __metaclass__ = SubfieldBase
 
     def __init__(self, version=4, node=None, clock_seq=None,
-            namespace=None, name=None, auto=False, hyphenate=False, *args, **kwargs):
+            namespace=None, name=None, auto=False, hyphenate=False, binary=False, *args, **kwargs):
         assert version in (1, 3, 4, 5), "UUID version %s is not supported." % version
         self.auto = auto
         self.version = version
         self.hyphenate = hyphenate
+        self.binary = binary
         # We store UUIDs in hex format, which is fixed at 32 characters.
         kwargs['max_length'] = 32
         if auto:
@@ -86,12 +119,23 @@ class UUIDField(Field):
             args = ()
         return getattr(uuid, 'uuid%s' % self.version)(*args)
 
+    def contribute_to_class(self, cls, name):
+        super(UUIDField, self).contribute_to_class(cls, name)
+        setattr(cls, self.name, UUIDDescriptor(self))
+
     def db_type(self, connection=None):
         """
-        Return the special uuid data type on Postgres databases.
+        Return the special uuid data type on Postgres databases, a 16 byte
+        binary type elsewhere if binary is set.
         """
         if connection and 'postgres' in connection.vendor:
             return 'uuid'
+        if self.binary and connection:
+            if connection.vendor == 'mysql':
+                return 'binary(16)'
+            if connection.vendor == 'oracle':
+                return 'raw(16)'
+            return 'blob'
         return 'char(%s)' % self.max_length
 
     def pre_save(self, model_instance, add):
@@ -111,6 +155,10 @@ class UUIDField(Field):
         """
         Casts uuid.UUID values into the format expected by the back end
         """
+        if self.binary and value and 'postgres' not in connection.vendor:
+            if not isinstance(value, uuid.UUID):
+                value = self.to_python(value)
+            return connection.Database.Binary(value.bytes)
         if isinstance(value, uuid.UUID):
             value = str(value)
         if isinstance(value, str):
@@ -135,9 +183,17 @@ class UUIDField(Field):
         """
         if not value:
             return None
+        cls = HyphenatedStringUUID if self.hyphenate else StringUUID
+        if isinstance(value, cls):
+            return value
+        if isinstance(value, uuid.UUID):
+            return cls(int=value.int)
+        # 16 raw bytes from binary storage
+        if isinstance(value, (buffer, bytearray)) or (isinstance(value, str) and len(value) == 16):
+            return cls(bytes=str(value))
         # attempt to parse a UUID including cases in which value is a UUID
         # instance already to be able to get our StringUUID in.
-        return StringUUID(smart_unicode(value), hyphenate=self.hyphenate)
+        return cls(smart_unicode(value))
 
     def formfield(self, **kwargs):
         defaults = {
@@ -147,8 +203,73 @@ class UUIDField(Field):
         defaults.update(kwargs)
         return super(UUIDField, self).formfield(**defaults)
 
+
+
+def convert_uuid_column(table, column='uuid', pk='id', unique=True):
+    """
+    Convert an existing hex char(32) uuid column, like DistributedMixin.uuid before
+    DISTRIBUTED_UUID_STORAGE = 'binary', to UUIDField(binary=True) storage and add a
+    unique index. Meant to replace the generated alter_column in a South migration:
+
+        def forwards(self, orm):
+            convert_uuid_column(u'myapp_mymodel')
+    """
+    from south.db import db
+    field = UUIDField(binary=True)
+    if db.backend_name == 'postgres':
+        db.execute('ALTER TABLE %s ALTER COLUMN %s TYPE uuid USING %s::uuid' % (
+            db.quote_name(table), db.quote_name(column), db.quote_name(column)))
+    else:
+        temp = column + '_binary'
+        db.add_column(table, temp, UUIDField(binary=True, null=True))
+        rows = db.execute('SELECT %s, %s FROM %s' % (db.quote_name(pk), db.quote_name(column), db.quote_name(table)))
+        for row_pk, value in rows:
+            db.execute('UPDATE %s SET %s = %%s WHERE %s = %%s' % (
+                db.quote_name(table), db.quote_name(temp), db.quote_name(pk)),
+                [field.get_db_prep_save(value, connection=connection), row_pk])
+        db.delete_column(table, column)
+        db.rename_column(table, temp, column)
+        db.alter_column(table, column, field)
+    if unique:
+        db.create_unique(table, [column])
+
+
+
+def live_index_sql(table, column='uuid', pk='id', dated=False, unique=True, using=connection):
+    """
+    CREATE INDEX statements for DISTRIBUTED_UUID_INDEXES on the table of a DistributedMixin
+    model: a unique index on the uuid (unless the column is unique already) and, on
+    Postgres and SQLite, partial indexes over the live rows (WHERE date_deleted IS NULL)
+    that UndeleteManager queries by default - on the pk, and with dated on (modified_date,
+    uuid) as well. Run them from a South migration, or see manage.py create_live_indexes:
+
+        def forwards(self, orm):
+            for sql in live_index_sql(u'myapp_mymodel', dated=True):
+                db.execute(sql)
+    """
+    from django.db.backends.util import truncate_name
+    qn = using.ops.quote_name
+    partial = using.vendor in ('postgresql', 'sqlite')
+    create = 'CREATE %sINDEX IF NOT EXISTS %s ON %s (%s)%s' if partial else 'CREATE %sINDEX %s ON %s (%s)%s'
+    indexes = []
+    if unique:
+        indexes.append(('UNIQUE ', 'uuid_uniq', [column], ''))
+    if partial:
+        indexes.append(('', 'live', [pk], ' WHERE date_deleted IS NULL'))
+        if dated:
+            indexes.append(('', 'live_modified', ['modified_date', column], ' WHERE date_deleted IS NULL'))
+    return [create % (kind, qn(truncate_name('%s_%s' % (table, suffix), using.ops.max_name_length())), qn(table),
+                      ', '.join(qn(name) for name in columns), where)
+            for kind, suffix, columns, where in indexes]
+
 try:
     from south.modelsinspector import add_introspection_rules
-    add_introspection_rules([], ['^distributed\.fields\.UUIDField'],)
+    add_introspection_rules([
+        (
+            [UUIDField],
+            [],
+            {'binary': ['binary', {'default': False}]},
+        ),
+    ], ['^distributed\.fields\.UUIDField'],)
 except ImportError:
     pass
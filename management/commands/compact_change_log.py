@@ -0,0 +1,17 @@
+from optparse import make_option
+from django.core.management.base import BaseCommand
+
+from distributed.models import ChangeLogEntry
+
+
+class Command(BaseCommand):
+    args = ''
+    help = 'Delete all but the latest change log entry of every row'
+    option_list = BaseCommand.option_list + (
+        make_option('--before', type='int', dest='before', default=None,
+            help='Only compact the entries up to this sequence number'),
+    )
+
+    def handle(self, *args, **options):
+        deleted = ChangeLogEntry.objects.compact(options['before'])
+        self.stdout.write('Deleted %d change log entries' % deleted)
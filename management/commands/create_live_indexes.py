@@ -0,0 +1,37 @@
+from optparse import make_option
+from django.core.management.base import BaseCommand
+from django.db import DatabaseError, connections, models, router, transaction
+
+from distributed.fields import live_index_sql
+from distributed.models import DistributedMixin
+
+
+class Command(BaseCommand):
+    args = ''
+    help = 'Create the unique uuid and live row indexes of DISTRIBUTED_UUID_INDEXES on every DistributedMixin table'
+    option_list = BaseCommand.option_list + (
+        make_option('--sql', action='store_true', dest='sql', default=False,
+            help='Only print the statements'),
+    )
+
+    def handle(self, *args, **options):
+        for model in models.get_models():
+            if not issubclass(model, DistributedMixin) or model._meta.proxy:
+                continue
+            using = connections[router.db_for_write(model)]
+            uuid_field = model._meta.get_field('uuid')
+            statements = live_index_sql(model._meta.db_table, uuid_field.column, model._meta.pk.column,
+                                        dated='modified_date' in [field.name for field in model._meta.fields],
+                                        unique=not uuid_field.unique, using=using)
+            for sql in statements:
+                if options['sql']:
+                    self.stdout.write(sql + ';')
+                    continue
+                try:
+                    with transaction.atomic(using=using.alias):
+                        using.cursor().execute(sql)
+                except DatabaseError, e:
+                    # e.g. duplicate uuids for the unique index
+                    self.stdout.write('%s: %s' % (model._meta.db_table, e))
+                else:
+                    self.stdout.write(sql)
@@ -1,12 +1,136 @@
+import signal
+import threading
+import time
+from optparse import make_option
 from django.core.management.base import BaseCommand, CommandError
+from django.db import close_old_connections, connections
+from django.db.models import Q
+from django.utils import timezone
 
-from distributed.models import DistributedSource
+from distributed.models import DistributedSource, SyncRun
+from distributed.utils import run_in_threads
 
 
 class Command(BaseCommand):
     args = ''
     help = 'Sync all the remote sources'
+    option_list = BaseCommand.option_list + (
+        make_option('--full', action='store_true', dest='full', default=False,
+            help='Ignore the sync watermarks and pull every record from the sources'),
+        make_option('--workers', type='int', dest='workers', default=1,
+            help='Number of sources to sync concurrently'),
+        make_option('--source-workers', type='int', dest='source_workers', default=1,
+            help='Number of models to sync concurrently within one source'),
+        make_option('--daemon', action='store_true', dest='daemon', default=False,
+            help='Keep running and sync every source when its sync_interval is up, until SIGTERM / SIGINT'),
+        make_option('--poll', type='float', dest='poll', default=10,
+            help='Seconds between checks for sources that are due, with --daemon'),
+        make_option('--reconcile', action='store_true', dest='reconcile', default=False,
+            help='After each sync, check the models against the source for deleted and drifted records'),
+        make_option('--push', action='store_true', dest='push', default=False,
+            help='Push the changes since the last push to the sources with a push_url - always on with --daemon'),
+    )
 
     def handle(self, *args, **options):
-        for source in DistributedSource.objects.filter(active=True):
-            source.sync()
+        if options['workers'] < 1 or options['source_workers'] < 1:
+            raise CommandError('--workers and --source-workers must be at least 1')
+        self.options = options
+        if options['daemon']:
+            return self.daemon()
+        sources = DistributedSource.objects.filter(active=True)
+        results = run_in_threads(self.sync, sources, options['workers'])
+        # summary
+        for source, result, exception in results:
+            self.report(source, exception)
+        if options['push']:
+            self.push()
+
+    def sync(self, source, run=None):
+        start = time.time()
+        full = run.full if run is not None else self.options['full']
+        try:
+            source.skipped = not source.sync(full=full, workers=self.options['source_workers'], run=run)
+            if self.options['reconcile'] and not source.skipped:
+                for source_model in source.models.filter(active=True):
+                    result = source_model.reconcile()
+                    self.stdout.write('%-50s reconciled: %d deleted, %d drifted, %d requests' % (
+                        source_model, result['deleted'], result['drifted'], result['requests']))
+        finally:
+            source.duration = time.time() - start
+
+    def report(self, source, exception=None):
+        if exception is not None:
+            outcome = 'Exception: %s' % exception
+        elif source.skipped:
+            outcome = 'Skipped - already being synced'
+        else:
+            outcome = source.last_sync_message
+        self.stdout.write('%-50s %8.1fs  %s' % (source, source.duration, outcome))
+
+    def push(self):
+        """ Push the local changes to every active source with a push_url """
+        for source in DistributedSource.objects.filter(active=True).exclude(push_url__isnull=True).exclude(push_url=''):
+            try:
+                count = source.push_changes()
+            except Exception, e:
+                self.stdout.write('%-50s push failed: %s' % (source, e))
+            else:
+                if count:
+                    self.stdout.write('%-50s pushed %d records' % (source, count))
+
+    def daemon(self):
+        """
+        Sync each active source whenever its next_sync is due, and run the syncs queued
+        from the admin, on up to --workers threads. A source is never picked up while it
+        is being synced here, and the sync lock keeps other processes off it. On
+        SIGTERM / SIGINT no new syncs are started and the running ones are waited for.
+        Local changes are pushed to the sources with a push_url on every poll.
+        """
+        stopping = threading.Event()
+        # source pk -> thread of the due syncs, run pk -> thread of the queued ones
+        running, queued = {}, {}
+
+        def stop(signum, frame):
+            self.stdout.write('Stopping - waiting for %d running syncs' % (len(running) + len(queued)))
+            stopping.set()
+
+        def sync(source, run=None):
+            exception = None
+            try:
+                self.sync(source, run)
+            except Exception, e:
+                exception = e
+            finally:
+                for connection in connections.all():
+                    connection.close()
+            # a source locked by another process is tried again on the next poll
+            if exception is not None or not source.skipped:
+                self.report(source, exception)
+
+        signal.signal(signal.SIGTERM, stop)
+        signal.signal(signal.SIGINT, stop)
+        while not stopping.is_set():
+            close_old_connections()
+            for threads in (running, queued):
+                for pk, thread in threads.items():
+                    if not thread.is_alive():
+                        del threads[pk]
+            free = self.options['workers'] - len(running) - len(queued)
+            if free > 0:
+                due = DistributedSource.objects.filter(active=True).filter(
+                    Q(next_sync__isnull=True) | Q(next_sync__lte=timezone.now())
+                ).exclude(pk__in=running.keys()).order_by('next_sync')
+                for source in due[:free]:
+                    running[source.pk] = threading.Thread(target=sync, args=(source,))
+                    running[source.pk].start()
+            while len(running) + len(queued) < self.options['workers']:
+                # a queued run of a source synced here would only be queued again
+                run = SyncRun.objects.claim_next(running.keys())
+                if run is None:
+                    break
+                queued[run.pk] = threading.Thread(target=sync, args=(run.source, run))
+                queued[run.pk].start()
+            self.push()
+            stopping.wait(self.options['poll'])
+        for thread in running.values() + queued.values():
+            thread.join()
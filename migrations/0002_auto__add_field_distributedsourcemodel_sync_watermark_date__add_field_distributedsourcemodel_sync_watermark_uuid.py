@@ -0,0 +1,58 @@
+# -*- coding: utf-8 -*-
+from south.utils import datetime_utils as datetime
+from south.db import db
+from south.v2 import SchemaMigration
+from django.db import models
+
+
+class Migration(SchemaMigration):
+
+    def forwards(self, orm):
+        # Adding field 'DistributedSourceModel.sync_watermark_date'
+        db.add_column(u'distributed_distributedsourcemodel', 'sync_watermark_date',
+                      self.gf('django.db.models.fields.DateTimeField')(null=True),
+                      keep_default=False)
+
+        # Adding field 'DistributedSourceModel.sync_watermark_uuid'
+        db.add_column(u'distributed_distributedsourcemodel', 'sync_watermark_uuid',
+                      self.gf('django.db.models.fields.CharField')(max_length=32, null=True),
+                      keep_default=False)
+
+
+    def backwards(self, orm):
+        # Deleting field 'DistributedSourceModel.sync_watermark_date'
+        db.delete_column(u'distributed_distributedsourcemodel', 'sync_watermark_date')
+
+        # Deleting field 'DistributedSourceModel.sync_watermark_uuid'
+        db.delete_column(u'distributed_distributedsourcemodel', 'sync_watermark_uuid')
+
+
+    models = {
+        u'distributed.distributedsource': {
+            'Meta': {'object_name': 'DistributedSource'},
+            'active': ('django.db.models.fields.BooleanField', [], {'default': 'True'}),
+            'api_password': ('django.db.models.fields.CharField', [], {'max_length': '50', 'null': 'True', 'blank': 'True'}),
+            'api_url': ('django.db.models.fields.CharField', [], {'max_length': '200', 'null': 'True', 'blank': 'True'}),
+            'api_username': ('django.db.models.fields.CharField', [], {'max_length': '50', 'null': 'True', 'blank': 'True'}),
+            u'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'}),
+            'last_sync': ('django.db.models.fields.DateTimeField', [], {'null': 'True'}),
+            'last_sync_message': ('django.db.models.fields.CharField', [], {'max_length': '200', 'null': 'True'}),
+            'name': ('django.db.models.fields.CharField', [], {'max_length': '50'}),
+            'notes': ('django.db.models.fields.TextField', [], {'null': 'True', 'blank': 'True'})
+        },
+        u'distributed.distributedsourcemodel': {
+            'Meta': {'ordering': "('order',)", 'object_name': 'DistributedSourceModel'},
+            'active': ('django.db.models.fields.BooleanField', [], {'default': 'False'}),
+            'api_url': ('django.db.models.fields.CharField', [], {'max_length': '200', 'null': 'True', 'blank': 'True'}),
+            u'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'}),
+            'last_sync': ('django.db.models.fields.DateTimeField', [], {'null': 'True'}),
+            'last_sync_message': ('django.db.models.fields.CharField', [], {'max_length': '200', 'null': 'True'}),
+            'order': ('django.db.models.fields.PositiveSmallIntegerField', [], {'default': '0'}),
+            'resource_name': ('django.db.models.fields.CharField', [], {'max_length': '50'}),
+            'source': ('django.db.models.fields.related.ForeignKey', [], {'related_name': "'models'", 'to': u"orm['distributed.DistributedSource']"}),
+            'sync_watermark_date': ('django.db.models.fields.DateTimeField', [], {'null': 'True'}),
+            'sync_watermark_uuid': ('django.db.models.fields.CharField', [], {'max_length': '32', 'null': 'True'})
+        }
+    }
+
+    complete_apps = ['distributed']
@@ -0,0 +1,49 @@
+# -*- coding: utf-8 -*-
+from south.utils import datetime_utils as datetime
+from south.db import db
+from south.v2 import SchemaMigration
+from django.db import models
+
+
+class Migration(SchemaMigration):
+
+    def forwards(self, orm):
+        # Deleting field 'DistributedSourceModel.order'
+        db.delete_column(u'distributed_distributedsourcemodel', 'order')
+
+
+    def backwards(self, orm):
+        # Adding field 'DistributedSourceModel.order'
+        db.add_column(u'distributed_distributedsourcemodel', 'order',
+                      self.gf('django.db.models.fields.PositiveSmallIntegerField')(default=0),
+                      keep_default=False)
+
+
+    models = {
+        u'distributed.distributedsource': {
+            'Meta': {'object_name': 'DistributedSource'},
+            'active': ('django.db.models.fields.BooleanField', [], {'default': 'True'}),
+            'api_password': ('django.db.models.fields.CharField', [], {'max_length': '50', 'null': 'True', 'blank': 'True'}),
+            'api_url': ('django.db.models.fields.CharField', [], {'max_length': '200', 'null': 'True', 'blank': 'True'}),
+            'api_username': ('django.db.models.fields.CharField', [], {'max_length': '50', 'null': 'True', 'blank': 'True'}),
+            u'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'}),
+            'last_sync': ('django.db.models.fields.DateTimeField', [], {'null': 'True'}),
+            'last_sync_message': ('django.db.models.fields.CharField', [], {'max_length': '200', 'null': 'True'}),
+            'name': ('django.db.models.fields.CharField', [], {'max_length': '50'}),
+            'notes': ('django.db.models.fields.TextField', [], {'null': 'True', 'blank': 'True'})
+        },
+        u'distributed.distributedsourcemodel': {
+            'Meta': {'ordering': "('resource_name',)", 'object_name': 'DistributedSourceModel'},
+            'active': ('django.db.models.fields.BooleanField', [], {'default': 'False'}),
+            'api_url': ('django.db.models.fields.CharField', [], {'max_length': '200', 'null': 'True', 'blank': 'True'}),
+            u'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'}),
+            'last_sync': ('django.db.models.fields.DateTimeField', [], {'null': 'True'}),
+            'last_sync_message': ('django.db.models.fields.CharField', [], {'max_length': '200', 'null': 'True'}),
+            'resource_name': ('django.db.models.fields.CharField', [], {'max_length': '50'}),
+            'source': ('django.db.models.fields.related.ForeignKey', [], {'related_name': "'models'", 'to': u"orm['distributed.DistributedSource']"}),
+            'sync_watermark_date': ('django.db.models.fields.DateTimeField', [], {'null': 'True'}),
+            'sync_watermark_uuid': ('django.db.models.fields.CharField', [], {'max_length': '32', 'null': 'True'})
+        }
+    }
+
+    complete_apps = ['distributed']
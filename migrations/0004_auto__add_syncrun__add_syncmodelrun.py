@@ -0,0 +1,109 @@
+# -*- coding: utf-8 -*-
+from south.utils import datetime_utils as datetime
+from south.db import db
+from south.v2 import SchemaMigration
+from django.db import models
+
+
+class Migration(SchemaMigration):
+
+    def forwards(self, orm):
+        # Adding model 'SyncRun'
+        db.create_table(u'distributed_syncrun', (
+            (u'id', self.gf('django.db.models.fields.AutoField')(primary_key=True)),
+            ('source', self.gf('django.db.models.fields.related.ForeignKey')(related_name='runs', to=orm['distributed.DistributedSource'])),
+            ('started', self.gf('django.db.models.fields.DateTimeField')()),
+            ('finished', self.gf('django.db.models.fields.DateTimeField')(null=True)),
+            ('status', self.gf('django.db.models.fields.CharField')(max_length=20)),
+            ('message', self.gf('django.db.models.fields.CharField')(max_length=200, null=True)),
+        ))
+        db.send_create_signal(u'distributed', ['SyncRun'])
+
+        # Adding model 'SyncModelRun'
+        db.create_table(u'distributed_syncmodelrun', (
+            (u'id', self.gf('django.db.models.fields.AutoField')(primary_key=True)),
+            ('run', self.gf('django.db.models.fields.related.ForeignKey')(related_name='model_runs', null=True, to=orm['distributed.SyncRun'])),
+            ('source_model', self.gf('django.db.models.fields.related.ForeignKey')(related_name='runs', to=orm['distributed.DistributedSourceModel'])),
+            ('started', self.gf('django.db.models.fields.DateTimeField')()),
+            ('finished', self.gf('django.db.models.fields.DateTimeField')(null=True)),
+            ('message', self.gf('django.db.models.fields.CharField')(max_length=200, null=True)),
+            ('fetch_time', self.gf('django.db.models.fields.FloatField')(default=0)),
+            ('parse_time', self.gf('django.db.models.fields.FloatField')(default=0)),
+            ('resolve_time', self.gf('django.db.models.fields.FloatField')(default=0)),
+            ('write_time', self.gf('django.db.models.fields.FloatField')(default=0)),
+            ('bytes_transferred', self.gf('django.db.models.fields.BigIntegerField')(default=0)),
+            ('records_seen', self.gf('django.db.models.fields.PositiveIntegerField')(default=0)),
+            ('records_inserted', self.gf('django.db.models.fields.PositiveIntegerField')(default=0)),
+            ('records_updated', self.gf('django.db.models.fields.PositiveIntegerField')(default=0)),
+            ('records_skipped', self.gf('django.db.models.fields.PositiveIntegerField')(default=0)),
+            ('query_count', self.gf('django.db.models.fields.PositiveIntegerField')(default=0)),
+            ('query_time', self.gf('django.db.models.fields.FloatField')(default=0)),
+        ))
+        db.send_create_signal(u'distributed', ['SyncModelRun'])
+
+
+    def backwards(self, orm):
+        # Deleting model 'SyncRun'
+        db.delete_table(u'distributed_syncrun')
+
+        # Deleting model 'SyncModelRun'
+        db.delete_table(u'distributed_syncmodelrun')
+
+
+    models = {
+        u'distributed.distributedsource': {
+            'Meta': {'object_name': 'DistributedSource'},
+            'active': ('django.db.models.fields.BooleanField', [], {'default': 'True'}),
+            'api_password': ('django.db.models.fields.CharField', [], {'max_length': '50', 'null': 'True', 'blank': 'True'}),
+            'api_url': ('django.db.models.fields.CharField', [], {'max_length': '200', 'null': 'True', 'blank': 'True'}),
+            'api_username': ('django.db.models.fields.CharField', [], {'max_length': '50', 'null': 'True', 'blank': 'True'}),
+            u'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'}),
+            'last_sync': ('django.db.models.fields.DateTimeField', [], {'null': 'True'}),
+            'last_sync_message': ('django.db.models.fields.CharField', [], {'max_length': '200', 'null': 'True'}),
+            'name': ('django.db.models.fields.CharField', [], {'max_length': '50'}),
+            'notes': ('django.db.models.fields.TextField', [], {'null': 'True', 'blank': 'True'})
+        },
+        u'distributed.distributedsourcemodel': {
+            'Meta': {'ordering': "('resource_name',)", 'object_name': 'DistributedSourceModel'},
+            'active': ('django.db.models.fields.BooleanField', [], {'default': 'False'}),
+            'api_url': ('django.db.models.fields.CharField', [], {'max_length': '200', 'null': 'True', 'blank': 'True'}),
+            u'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'}),
+            'last_sync': ('django.db.models.fields.DateTimeField', [], {'null': 'True'}),
+            'last_sync_message': ('django.db.models.fields.CharField', [], {'max_length': '200', 'null': 'True'}),
+            'resource_name': ('django.db.models.fields.CharField', [], {'max_length': '50'}),
+            'source': ('django.db.models.fields.related.ForeignKey', [], {'related_name': "'models'", 'to': u"orm['distributed.DistributedSource']"}),
+            'sync_watermark_date': ('django.db.models.fields.DateTimeField', [], {'null': 'True'}),
+            'sync_watermark_uuid': ('django.db.models.fields.CharField', [], {'max_length': '32', 'null': 'True'})
+        },
+        u'distributed.syncmodelrun': {
+            'Meta': {'ordering': "('-started',)", 'object_name': 'SyncModelRun'},
+            'bytes_transferred': ('django.db.models.fields.BigIntegerField', [], {'default': '0'}),
+            'fetch_time': ('django.db.models.fields.FloatField', [], {'default': '0'}),
+            'finished': ('django.db.models.fields.DateTimeField', [], {'null': 'True'}),
+            u'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'}),
+            'message': ('django.db.models.fields.CharField', [], {'max_length': '200', 'null': 'True'}),
+            'parse_time': ('django.db.models.fields.FloatField', [], {'default': '0'}),
+            'query_count': ('django.db.models.fields.PositiveIntegerField', [], {'default': '0'}),
+            'query_time': ('django.db.models.fields.FloatField', [], {'default': '0'}),
+            'records_inserted': ('django.db.models.fields.PositiveIntegerField', [], {'default': '0'}),
+            'records_seen': ('django.db.models.fields.PositiveIntegerField', [], {'default': '0'}),
+            'records_skipped': ('django.db.models.fields.PositiveIntegerField', [], {'default': '0'}),
+            'records_updated': ('django.db.models.fields.PositiveIntegerField', [], {'default': '0'}),
+            'resolve_time': ('django.db.models.fields.FloatField', [], {'default': '0'}),
+            'run': ('django.db.models.fields.related.ForeignKey', [], {'related_name': "'model_runs'", 'null': 'True', 'to': u"orm['distributed.SyncRun']"}),
+            'source_model': ('django.db.models.fields.related.ForeignKey', [], {'related_name': "'runs'", 'to': u"orm['distributed.DistributedSourceModel']"}),
+            'started': ('django.db.models.fields.DateTimeField', [], {}),
+            'write_time': ('django.db.models.fields.FloatField', [], {'default': '0'})
+        },
+        u'distributed.syncrun': {
+            'Meta': {'ordering': "('-started',)", 'object_name': 'SyncRun'},
+            'finished': ('django.db.models.fields.DateTimeField', [], {'null': 'True'}),
+            u'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'}),
+            'message': ('django.db.models.fields.CharField', [], {'max_length': '200', 'null': 'True'}),
+            'source': ('django.db.models.fields.related.ForeignKey', [], {'related_name': "'runs'", 'to': u"orm['distributed.DistributedSource']"}),
+            'started': ('django.db.models.fields.DateTimeField', [], {}),
+            'status': ('django.db.models.fields.CharField', [], {'max_length': '20'})
+        }
+    }
+
+    complete_apps = ['distributed']
@@ -1,26 +1,208 @@
+import json
+import multiprocessing
+import os
+import random
 import requests
+import socket
+import threading
+import time
 import uuid
+from collections import OrderedDict
+from datetime import timedelta
+from urllib import urlencode
+from requests.adapters import HTTPAdapter
 import pytz
 from django.conf import settings
-from django.db import models
-from django.db.models import Max
-from django.db.models.fields import DateTimeField
+from django.db import connections, models, router, transaction
+from django.db.models import F, Max, Q
+from django.db.models.fields import AutoField, DateTimeField
 from django.db.models.fields.related import ForeignKey
 from django.utils import timezone
 from django.utils.dateparse import parse_date, parse_datetime, parse_time
 from django.utils.translation import ugettext_lazy as _
 
 from distributed.fields import UUIDField
-from distributed.utils import unserialize_json
+from distributed.signals import sync_finished, sync_model_finished
+from distributed.utils import (ForeignKeyResolver, SyncStats, accept_header, bucket_digests, chunked, content_digest,
+                               dependency_levels, get_page, get_serialize_plan, push_signature, reconcile_row,
+                               run_in_threads, serialize_values, unserialize_json_list, uuid_hex, uuid_ranges)
+
+try:
+    from requests.packages.urllib3.util.retry import Retry
+except ImportError:
+    Retry = None
+
+
+# records written per transaction during sync - keep below 999 for the uuid__in lookup on SQLite
+SYNC_BATCH_SIZE = getattr(settings, 'DISTRIBUTED_SYNC_BATCH_SIZE', 500)
+# (connect, read) timeouts in seconds for requests to sources
+HTTP_TIMEOUT = getattr(settings, 'DISTRIBUTED_HTTP_TIMEOUT', (10, 60))
+# retries on connection errors and 5xx responses, sleeping backoff * 2^n seconds between them
+HTTP_RETRIES = getattr(settings, 'DISTRIBUTED_HTTP_RETRIES', 3)
+HTTP_BACKOFF = getattr(settings, 'DISTRIBUTED_HTTP_BACKOFF', 0.5)
+# guards undelete against reference cycles in the data
+CASCADE_MAX_DEPTH = 32
+# scheduling (see sync_remote --daemon): the delay after a sync is sync_interval, doubled for every
+# failed sync in a row up to SYNC_MAX_BACKOFF seconds, and spread by +/- SYNC_JITTER
+SYNC_MAX_BACKOFF = getattr(settings, 'DISTRIBUTED_SYNC_MAX_BACKOFF', 24 * 3600)
+SYNC_JITTER = getattr(settings, 'DISTRIBUTED_SYNC_JITTER', 0.1)
+# syncs in a row a record with a missing reference holds the watermark back before it is given up
+SYNC_SKIPPED_RUNS = getattr(settings, 'DISTRIBUTED_SYNC_SKIPPED_RUNS', 5)
+# seconds a sync lock lasts unless renewed - a crashed process holds it at most this long
+SYNC_LOCK_TIMEOUT = getattr(settings, 'DISTRIBUTED_SYNC_LOCK_TIMEOUT', 3600)
+# where queued syncs (see DistributedSource.queue_sync) run: 'thread' - a background thread of the
+# process that queued them, or 'daemon' - only sync_remote --daemon
+SYNC_EXECUTOR = getattr(settings, 'DISTRIBUTED_SYNC_EXECUTOR', 'thread')
+# seconds the background thread waits for more queued syncs before it stops
+SYNC_EXECUTOR_IDLE = 10
+# SyncRun rows kept per DistributedSource
+SYNC_HISTORY = getattr(settings, 'DISTRIBUTED_SYNC_HISTORY', 100)
+# DistributedMixin.uuid storage: 'char' - 32 hex characters, or 'binary' - native uuid on
+# Postgres and 16 bytes elsewhere, with a unique index (see fields.convert_uuid_column)
+UUID_STORAGE = getattr(settings, 'DISTRIBUTED_UUID_STORAGE', 'char')
+# store a digest of the content of DistributedMixin records - sync then only writes rows whose
+# content changed, whatever their modified_date says (see utils.content_digest)
+CONTENT_HASH = getattr(settings, 'DISTRIBUTED_CONTENT_HASH', False)
+# reconciliation fetches the rows of a bucket once the source has no more than this many in it
+RECONCILE_LEAF_SIZE = getattr(settings, 'DISTRIBUTED_RECONCILE_LEAF_SIZE', 256)
+# the uuid of every DistributedMixin table has a unique index (see fields.live_index_sql) - sync then
+# writes with DistributedManager.bulk_upsert where the database supports it natively
+UUID_INDEXES = getattr(settings, 'DISTRIBUTED_UUID_INDEXES', False)
+# append a ChangeLogEntry for every save, delete and undelete of a DistributedMixin row
+CHANGE_LOG = getattr(settings, 'DISTRIBUTED_CHANGE_LOG', True)
+# change log entries pushed to a source per request, see DistributedSource.push_changes
+PUSH_BATCH_SIZE = getattr(settings, 'DISTRIBUTED_PUSH_BATCH_SIZE', 500)
+# seconds change log entries are left before they are pushed - an entry may commit after one with a
+# higher sequence, so this must outlast the longest transaction that writes DistributedMixin rows
+PUSH_LAG = getattr(settings, 'DISTRIBUTED_PUSH_LAG', 60)
+
+
+
+def conditional_headers(etag, last_modified):
+    """ If-None-Match / If-Modified-Since request headers for the validators of an earlier response """
+    headers = {}
+    if etag:
+        headers['If-None-Match'] = etag
+    if last_modified:
+        headers['If-Modified-Since'] = last_modified
+    return headers
+
+
+
+def stale_content_hash(model):
+    """ Extra update() values for rows of model changed in bulk - a cleared digest never matches """
+    if CONTENT_HASH and issubclass(model, DistributedMixin):
+        return {'content_hash': None}
+    return {}
+
+
+
+def deleted_values(model, timestamp):
+    """
+    Extra update() values for rows of model deleted or undeleted at timestamp - peers only
+    pull and apply rows with a newer modified_date
+    """
+    values = stale_content_hash(model)
+    if any(field.name == 'modified_date' and isinstance(field, DateTimeField) for field in model._meta.fields):
+        values['modified_date'] = timestamp
+    return values
+
+
+
+def log_changes(model, action, uuids):
+    """
+    Append a ChangeLogEntry per uuid of the rows of model that changed - from within the
+    transaction that changed them. uuids may be a queryset of the rows, only read when
+    the model is logged - UndeleteMixin models need not have a uuid.
+    """
+    if not CHANGE_LOG or not issubclass(model, DistributedMixin):
+        return
+    if isinstance(uuids, models.query.QuerySet):
+        uuids = uuids.values_list('uuid', flat=True)
+    label = '%s.%s' % (model._meta.app_label, model._meta.object_name)
+    now = timezone.now()
+    for chunk in chunked(uuids, SYNC_BATCH_SIZE):
+        ChangeLogEntry.objects.bulk_create([ChangeLogEntry(model=label, uuid=uuid_hex(row_uuid), action=action, date=now)
+                                            for row_uuid in chunk])
+
+
+
+def undelete_relations(model):
+    """ (related model, foreign key name) of the UndeleteMixin models referring to model """
+    return [(relation.model, relation.field.name) for relation in model._meta.get_all_related_objects()
+            if issubclass(relation.model, UndeleteMixin)]
+
+
+
+def cascade_delete(model, timestamp, counts):
+    """
+    Mark the live rows of related models deleted when the row they refer to was deleted at
+    timestamp - one UPDATE per relation, level by level. Adds the rows updated to counts.
+    """
+    pending = [model]
+    while pending:
+        model = pending.pop(0)
+        for related_model, field_name in undelete_relations(model):
+            related = related_model.objects.all_with_deleted().filter(**{
+                field_name + '__date_deleted': timestamp,
+                'date_deleted__isnull': True,
+            })
+            log_changes(related_model, 'delete', related)
+            count = related.update(date_deleted=timestamp, **deleted_values(related_model, timestamp))
+            if count:
+                counts[related_model] = counts.get(related_model, 0) + count
+                pending.append(related_model)
+    return counts
+
+
+
+def cascade_undelete(model, queryset, timestamp, counts, now=None):
+    """
+    Undelete the related rows deleted at timestamp below the rows in queryset (still deleted
+    at timestamp), deepest level first, then the rows in queryset, as modified at now. Adds
+    the rows updated to counts.
+    """
+    levels = []
+    pending = [(model, queryset, 0)]
+    while pending:
+        model, queryset, depth = pending.pop(0)
+        levels.append((model, queryset))
+        if depth >= CASCADE_MAX_DEPTH:
+            continue
+        for related_model, field_name in undelete_relations(model):
+            related = related_model.objects.all_with_deleted().filter(**{
+                field_name + '__in': queryset,
+                'date_deleted': timestamp,
+            })
+            if related.exists():
+                pending.append((related_model, related, depth + 1))
+    # the filters of each level depend on the level above still being deleted
+    now = now or timezone.now()
+    for model, queryset in reversed(levels):
+        log_changes(model, 'undelete', queryset)
+        count = queryset.update(date_deleted=None, **deleted_values(model, now))
+        if count:
+            counts[model] = counts.get(model, 0) + count
+    return counts
+
+
+
+class SyncLockLost(Exception):
+    """ The lock of a running sync expired and another process took it """
 
 
 
 class UndeleteQuerySet(models.query.QuerySet):
     def delete(self):
+        """ Mark the rows and their related rows deleted, returns {model: rows deleted} """
         assert self.query.can_filter(), "Cannot use 'limit' or 'offset' with delete."
-        for obj in self.all():
-            obj.delete()
+        timestamp = timezone.now()
+        with transaction.atomic():
+            log_changes(self.model, 'delete', self)
+            counts = {self.model: self.update(date_deleted=timestamp, **deleted_values(self.model, timestamp))}
+            cascade_delete(self.model, timestamp, counts)
         self._result_cache = None
+        return counts
     delete.alters_data = True
 
 
@@ -55,36 +237,30 @@ class UndeleteMixin(models.Model):
         abstract = True
 
     def delete(self, timestamp=None):
-        """ Mark related objects as deleted """
+        """ Mark this and related objects as deleted, returns {model: rows deleted} """
         timestamp = timestamp or timezone.now()
-        related = [relation.get_accessor_name() for relation in self._meta.get_all_related_objects()]
-        # delete related
-        for related_name in related:
-            objects = getattr(self, related_name).all()
-            for obj in objects:
-                # Only if they inherit from UndeleteMixin
-                if not issubclass(obj.__class__, UndeleteMixin):
-                    break
-                obj.delete(timestamp=timestamp)
-        # delete
-        self.date_deleted = timestamp
-        self.save()
+        with transaction.atomic():
+            self.date_deleted = timestamp
+            if 'modified_date' in deleted_values(self.__class__, timestamp):
+                self.modified_date = timestamp
+            self.save()
+            counts = cascade_delete(self.__class__, timestamp, {self.__class__: 1})
+        return counts
 
     def undelete(self):
-        """ Undelete all related objects with same date_deleted timestamp """
+        """ Undelete this and all related objects with the same date_deleted timestamp, returns {model: rows undeleted} """
         timestamp = self.date_deleted
-        related = [relation.get_accessor_name() for relation in self._meta.get_all_related_objects()]
-        # undelete related - if date_deleted timestamp matches
-        for related_name in related:
-            objects = getattr(self, related_name).filter(date_deleted=timestamp)
-            for obj in objects:
-                # Only if they inherit from Distributed
-                if not issubclass(obj.__class__, Distributed):
-                    break
-                obj.undelete()
-        # undelete
+        if not timestamp:
+            return {}
+        now = timezone.now()
+        with transaction.atomic():
+            queryset = self.__class__.objects.all_with_deleted().filter(pk=self.pk, date_deleted=timestamp)
+            counts = cascade_undelete(self.__class__, queryset, timestamp, {}, now)
+        # cascade_undelete() wrote and logged this row too - keep the instance in step
         self.date_deleted = None
-        self.save()
+        for name, value in deleted_values(self.__class__, now).items():
+            setattr(self, name, value)
+        return counts
 
 
 
@@ -92,15 +268,148 @@ class DistributedManager(UndeleteManager):
     def get_by_natural_key(self, uuid):
         return self.get(uuid=uuid)
 
+    def reconcile_rows(self, prefix='', **filters):
+        """
+        Generator yielding the utils.reconcile_row() of every row, deleted ones included,
+        whose uuid starts with the hex prefix. A range on the uuid rather than a LIKE,
+        so it works for both UUID_STORAGE settings and uses the index.
+        """
+        queryset = self.all_with_deleted().filter(**filters)
+        if prefix:
+            queryset = queryset.filter(uuid__gte=prefix.ljust(32, '0'), uuid__lte=prefix.ljust(32, 'f'))
+        dated = 'modified_date' in [field.name for field in self.model._meta.fields]
+        names = ('uuid', 'modified_date', 'date_deleted') if dated else ('uuid', 'date_deleted')
+        for row in queryset.values_list(*names).iterator():
+            yield reconcile_row(row[0], row[1] if dated else None, row[-1])
+
+    def bucket_digests(self, prefix='', **filters):
+        """ utils.bucket_digests() of the rows under prefix, one hex digit deeper """
+        return bucket_digests(self.reconcile_rows(prefix, **filters), len(prefix) + 1)
+
+    def native_upsert(self):
+        """
+        Whether bulk_upsert() runs as INSERT ... ON CONFLICT: the uuid needs a unique index,
+        and Postgres >= 9.5 or SQLite >= 3.35 (for RETURNING)
+        """
+        if not UUID_INDEXES and UUID_STORAGE != 'binary':
+            return False
+        connection = connections[router.db_for_write(self.model)]
+        if connection.vendor == 'postgresql':
+            return connection.pg_version >= 90500
+        if connection.vendor == 'sqlite':
+            return connection.Database.sqlite_version_info >= (3, 35, 0)
+        return False
+
+    def bulk_upsert(self, objs, fields=None):
+        """
+        Insert objs, or update the fields of the rows with the same uuid and an older
+        modified_date, without save(). Returns the (inserted, updated) uuids.
+        """
+        meta = self.model._meta
+        dated = 'modified_date' in [field.name for field in meta.fields]
+        by_uuid = OrderedDict()
+        for obj in objs:
+            if not obj.uuid:
+                obj.uuid = uuid.uuid4().hex
+            if CONTENT_HASH:
+                obj.content_hash = obj.get_content_hash()
+            by_uuid[uuid_hex(obj.uuid)] = obj
+        if fields is None:
+            fields = [field.name for field in meta.local_fields
+                      if not isinstance(field, AutoField) and field.name not in ('uuid', 'distributed_source')]
+        elif CONTENT_HASH:
+            fields = list(fields) + ['content_hash']
+        update_fields = [meta.get_field(name) for name in fields if name != 'uuid']
+        inserted, updated = [], []
+        with transaction.atomic(using=router.db_for_write(self.model)):
+            if self.native_upsert():
+                rows = self._native_upsert(by_uuid.values(), update_fields, dated)
+            else:
+                rows = self._emulate_upsert(by_uuid, update_fields, dated)
+            for row_uuid, is_insert, deleted in rows:
+                (inserted if is_insert else updated).append(row_uuid)
+            log_changes(self.model, 'save', [row_uuid for row_uuid, is_insert, deleted in rows if not deleted])
+            log_changes(self.model, 'delete', [row_uuid for row_uuid, is_insert, deleted in rows if deleted])
+        return inserted, updated
+
+    def _native_upsert(self, objs, update_fields, dated):
+        """ bulk_upsert() in SQL, returns (uuid, inserted, deleted) of the rows written """
+        connection = connections[router.db_for_write(self.model)]
+        meta = self.model._meta
+        qn = connection.ops.quote_name
+        table = qn(meta.db_table)
+        insert_fields = [field for field in meta.local_fields if not isinstance(field, AutoField)]
+        if update_fields:
+            action = 'UPDATE SET ' + ', '.join('%s = excluded.%s' % (qn(field.column), qn(field.column))
+                                               for field in update_fields)
+            if dated:
+                column = '%s.%s' % (table, qn('modified_date'))
+                action += ' WHERE %s IS NULL OR %s < excluded.%s' % (column, column, qn('modified_date'))
+                if CONTENT_HASH:
+                    content_hash = '%s.%s' % (table, qn('content_hash'))
+                    action += ' OR (%s = excluded.%s AND (%s IS NULL OR %s <> excluded.%s))' % (
+                        column, qn('modified_date'), content_hash, content_hash, qn('content_hash'))
+        else:
+            action = 'NOTHING'
+        # rows above the highest pk so far are new
+        highest = self.all_with_deleted().aggregate(highest=Max('pk'))['highest'] or 0
+        placeholders = '(%s)' % ', '.join(['%s'] * len(insert_fields))
+        # SQLite takes up to 999 parameters per statement
+        size = SYNC_BATCH_SIZE if connection.vendor != 'sqlite' else max(999 // len(insert_fields), 1)
+        cursor = connection.cursor()
+        rows = []
+        for chunk in chunked(objs, size):
+            params = []
+            for obj in chunk:
+                params.extend(field.get_db_prep_save(field.pre_save(obj, True), connection=connection)
+                              for field in insert_fields)
+            cursor.execute('INSERT INTO %s (%s) VALUES %s ON CONFLICT (%s) DO %s RETURNING %s, %s, %s' % (
+                table, ', '.join(qn(field.column) for field in insert_fields), ', '.join([placeholders] * len(chunk)),
+                qn(meta.get_field('uuid').column), action, qn(meta.pk.column), qn(meta.get_field('uuid').column),
+                qn('date_deleted')), params)
+            rows.extend((uuid_hex(row_uuid), pk > highest, deleted is not None) for pk, row_uuid, deleted in cursor.fetchall())
+        return rows
+
+    def _emulate_upsert(self, by_uuid, update_fields, dated):
+        """ bulk_upsert() for databases without ON CONFLICT, returns (uuid, inserted, deleted) of the rows written """
+        rows, created = [], []
+        for chunk in chunked(by_uuid.keys(), SYNC_BATCH_SIZE):
+            names = ('uuid', 'pk', 'modified_date') if dated else ('uuid', 'pk')
+            existing = dict((uuid_hex(row[0]), row[1:]) for row in self.all_with_deleted().filter(uuid__in=chunk).values_list(*names))
+            for row_uuid in chunk:
+                obj = by_uuid[row_uuid]
+                if row_uuid not in existing:
+                    created.append(obj)
+                    rows.append((row_uuid, True, obj.date_deleted is not None))
+                    continue
+                current = existing[row_uuid]
+                queryset = self.all_with_deleted().filter(pk=current[0])
+                if dated and current[1] is not None:
+                    if obj.modified_date is None or obj.modified_date < current[1]:
+                        continue
+                    if obj.modified_date == current[1]:
+                        if not CONTENT_HASH:
+                            continue
+                        queryset = queryset.exclude(content_hash=obj.content_hash)
+                values = dict((field.name, getattr(obj, field.attname)) for field in update_fields)
+                if update_fields and queryset.update(**values):
+                    rows.append((row_uuid, False, obj.date_deleted is not None))
+        self.bulk_create(created)
+        return rows
+
 
 
 class DistributedMixin(UndeleteMixin):
     """
     Assigns a UUID to each record, uses the UUID as natural key.
     """
-    uuid                      = models.CharField(max_length=32,       null=False, editable=False, db_index=True,    verbose_name='UUID')
-    #uuid                      = UUIDField(                            null=False, editable=False, db_index=True,    verbose_name='UUID')
+    if UUID_STORAGE == 'binary':
+        uuid                  = UUIDField(binary=True,                null=False, editable=False, unique=True,      verbose_name='UUID')
+    else:
+        uuid                  = models.CharField(max_length=32,       null=False, editable=False, db_index=True,    verbose_name='UUID')
     distributed_source        = models.ForeignKey('DistributedSource',null=True,  editable=False, related_name='+', verbose_name='UUID Source')
+    if CONTENT_HASH:
+        content_hash          = models.CharField(max_length=40,       null=True,  editable=False,                   verbose_name=_('Content hash'))
 #    created_date              = models.DateTimeField(                 null=False, editable=False, verbose_name=_('Created at'))
 #    modified_date             = models.DateTimeField(                 null=False, editable=False, verbose_name=_('Modified at'))
 
@@ -112,17 +421,24 @@ class DistributedMixin(UndeleteMixin):
     def natural_key(self):
         return (self.uuid,)
 
+    def get_content_hash(self):
+        return content_digest(self.__class__, self.__dict__)
+
     def save(self, audit=True, *args, **kwargs):
         # uuid
         if not self.uuid:
             self.uuid = uuid.uuid4().hex
+        if CONTENT_HASH:
+            self.content_hash = self.get_content_hash()
         # created
 #        if not self.created_date:
 #            self.created_date = timezone.now()
         # modified
 #        if audit:
 #            self.modified_date = timezone.now()
-        super(DistributedMixin, self).save(*args, **kwargs)
+        with transaction.atomic(using=kwargs.get('using') or router.db_for_write(self.__class__, instance=self), savepoint=False):
+            super(DistributedMixin, self).save(*args, **kwargs)
+            log_changes(self.__class__, 'delete' if self.date_deleted else 'save', [self.uuid])
 
 
 
@@ -138,6 +454,19 @@ class DistributedSource(models.Model):
     active                    = models.BooleanField(                  null=False, blank=False,    default=True)
     last_sync                 = models.DateTimeField(                 null=True,  editable=False)
     last_sync_message         = models.CharField(max_length=200,      null=True,  editable=False)
+    index_etag                = models.CharField(max_length=200,      null=True,  editable=False)
+    index_last_modified       = models.CharField(max_length=50,       null=True,  editable=False)
+    sync_interval             = models.PositiveIntegerField(          null=False, blank=False,    default=3600, verbose_name=_('Sync interval (seconds)'))
+    next_sync                 = models.DateTimeField(                 null=True,  editable=False)
+    failure_count             = models.PositiveIntegerField(          null=False, editable=False, default=0)
+    sync_locked_until         = models.DateTimeField(                 null=True,  editable=False)
+    sync_locked_by            = models.CharField(max_length=100,      null=True,  editable=False)
+    push_url                  = models.CharField(max_length=200,      null=True,  blank=True,     help_text=_('Where the source accepts pushed changes, e.g. https://peer/distributed/push/3/'))
+    push_secret               = models.CharField(max_length=100,      null=True,  blank=True,     help_text=_('Shared with the source - signs the changes pushed either way'))
+    push_sequence             = models.PositiveIntegerField(          null=False, editable=False, default=0)
+
+    class Meta:
+        permissions = (('publish', _('Can read the published models')),)
 
     def __unicode__(self):
         return self.name
@@ -145,39 +474,270 @@ class DistributedSource(models.Model):
     def save(self, *args, **kwargs):
         super(DistributedSource, self).save(*args, **kwargs)
 
-    def request(self, extra_url=None):
+    def acquire_lock(self, owner):
+        """
+        Take (or renew) the sync lock for owner with a conditional UPDATE, unless another
+        owner holds a lock that hasn't expired. Returns True when owner has the lock.
+        """
+        now = timezone.now()
+        locked_until = now + timedelta(seconds=SYNC_LOCK_TIMEOUT)
+        if not DistributedSource.objects.filter(pk=self.pk).filter(
+                Q(sync_locked_until__isnull=True) | Q(sync_locked_until__lt=now) | Q(sync_locked_by=owner)
+                ).update(sync_locked_until=locked_until, sync_locked_by=owner):
+            return False
+        # keep the instance in step with the row
+        self.sync_locked_until, self.sync_locked_by = locked_until, owner
+        return True
+
+    def save_sync_status(self):
+        """ Write the outcome of a sync only - the rest may have been edited or pushed meanwhile """
+        super(DistributedSource, self).save(update_fields=['last_sync', 'last_sync_message', 'index_etag', 'index_last_modified'])
+
+    def renew_lock(self):
+        """
+        Renew the lock of the running sync once half of it has passed - called after every
+        batch. Raises SyncLockLost when another process took the lock over meanwhile.
+        """
+        owner = getattr(self, '_lock_owner', None)
+        if not owner:
+            return
+        if self.sync_locked_until and self.sync_locked_until - timezone.now() > timedelta(seconds=SYNC_LOCK_TIMEOUT / 2.0):
+            return
+        if not self.acquire_lock(owner):
+            raise SyncLockLost('Sync lock of %s lost - another process is syncing it' % self)
+
+    def release_lock(self, owner):
+        DistributedSource.objects.filter(pk=self.pk, sync_locked_by=owner).update(
+            sync_locked_until=None, sync_locked_by=None)
+        self.sync_locked_until, self.sync_locked_by = None, None
+
+    def schedule_next(self, success):
+        """ Set next_sync a sync_interval from now, backing off while syncs keep failing """
+        self.failure_count = 0 if success else self.failure_count + 1
+        delay = min(self.sync_interval * 2 ** self.failure_count, max(self.sync_interval, SYNC_MAX_BACKOFF))
+        delay *= 1 + random.uniform(-SYNC_JITTER, SYNC_JITTER)
+        self.next_sync = timezone.now() + timedelta(seconds=delay)
+        # only these two - the rest may have been edited in the admin meanwhile
+        DistributedSource.objects.filter(pk=self.pk).update(next_sync=self.next_sync, failure_count=self.failure_count)
+
+    def get_session(self):
+        """ Keep-alive session reused by every request to this source """
+        if getattr(self, '_session', None) is None:
+            if Retry is not None:
+                retries = Retry(total=HTTP_RETRIES, backoff_factor=HTTP_BACKOFF,
+                                status_forcelist=(500, 502, 503, 504))
+            else:
+                retries = HTTP_RETRIES
+            adapter = HTTPAdapter(max_retries=retries)
+            session = requests.Session()
+            session.mount('http://', adapter)
+            session.mount('https://', adapter)
+            session.auth = (self.api_username, self.api_password)
+            session.headers['Accept-Encoding'] = 'gzip, deflate'
+            self._session = session
+        return self._session
+
+    def close_session(self):
+        if getattr(self, '_session', None) is not None:
+            self._session.close()
+            self._session = None
+
+    def request(self, extra_url=None, params=None, stream=False, headers=None):
         url = self.api_url
-        if extra_url:
+        if extra_url and extra_url.startswith(('http://', 'https://')):
+            # absolute url, e.g. the next page of a paginated resource
+            url = extra_url
+        elif extra_url:
             if url[-1] != '/': url += '/'
             url += extra_url
-        return requests.get(url, auth=(self.api_username, self.api_password))
+        return self.get_session().get(url, params=params, stream=stream, headers=headers, timeout=HTTP_TIMEOUT)
+
+    def push(self, resource, records):
+        """ POST records to the source's push_url for resource, signed with push_secret """
+        body = json.dumps({'results': records})
+        url = self.push_url
+        if url[-1] != '/': url += '/'
+        headers = {'Content-Type': 'application/json', 'X-Distributed-Signature': push_signature(self.push_secret, body)}
+        response = self.get_session().post(url + resource, data=body, headers=headers, timeout=HTTP_TIMEOUT)
+        try:
+            response.raise_for_status()
+        except requests.exceptions.HTTPError, e:
+            raise requests.exceptions.HTTPError('%s (%s: %s)' % (e.message, self, resource))
+        return response.json()
+
+    def push_changes(self):
+        """
+        Push the rows changed since push_sequence, read from the change log, to the source -
+        for the active models synced from it, in the order they are synced and in batches
+        of PUSH_BATCH_SIZE entries. Rows that came from the source are not sent back.
+        Entries younger than PUSH_LAG wait for the next push, see ChangeLogManager.since().
+        push_sequence only moves on once a batch is accepted, so a failed push is retried
+        from there. Returns the number of records pushed.
+        """
+        if not self.push_url or not self.push_secret:
+            return 0
+        # (source model, model class, change log label) in sync order
+        plan = []
+        for level, deferred_fields in self.get_sync_plan(self.models.filter(active=True)):
+            for model in level:
+                cls = model.get_model_class()
+                if cls:
+                    plan.append((model, cls, '%s.%s' % (cls._meta.app_label, cls._meta.object_name)))
+        total = 0
+        while True:
+            entries = ChangeLogEntry.objects.since(self.push_sequence, PUSH_BATCH_SIZE, [label for model, cls, label in plan],
+                                                   timezone.now() - timedelta(seconds=PUSH_LAG))
+            if not entries:
+                return total
+            uuids = {}
+            for entry in entries:
+                uuids.setdefault(entry.model, set()).add(entry.uuid)
+            for model, cls, label in plan:
+                if label not in uuids:
+                    continue
+                serialize_plan = get_serialize_plan(cls)
+                queryset = cls.objects.all_with_deleted().filter(uuid__in=list(uuids[label])).exclude(distributed_source=self)
+                records = [serialize_values(row, serialize_plan) for row in queryset.values(*serialize_plan[0])]
+                if records:
+                    self.push(model.resource_name, records)
+                    total += len(records)
+            self.push_sequence = entries[-1].pk
+            DistributedSource.objects.filter(pk=self.pk).update(push_sequence=self.push_sequence)
+
+    def get_sync_plan(self, source_models):
+        """
+        Order source models by the ForeignKeys between their model classes. Returns a list
+        of (level, deferred_fields) - every model in a level only depends on models in
+        earlier levels. Models that are in (or depend on) a dependency cycle make up a
+        last level; their foreign keys into that level, and self references, are
+        deferred (see unserialize_json) and fixed up once the level is done.
+        """
+        classes = dict((model, model.get_model_class()) for model in source_models)
+        models_by_class = dict((cls, model) for model, cls in classes.items() if cls)
+        graph, self_references = {}, {}
+        for model, cls in classes.items():
+            graph[model] = set()
+            if not cls:
+                continue
+            for field in cls._meta.fields:
+                if not isinstance(field, ForeignKey) or field.rel.to not in models_by_class:
+                    continue
+                if field.rel.to is cls:
+                    self_references.setdefault(model, set()).add(field.name)
+                else:
+                    graph[model].add(models_by_class[field.rel.to])
+        levels, cyclic = dependency_levels(graph)
+        plan = [(level, self_references) for level in levels]
+        if cyclic:
+            deferred_fields = {}
+            for model in cyclic:
+                cls = classes[model]
+                deferred_fields[model] = set(field.name for field in cls._meta.fields
+                    if isinstance(field, ForeignKey) and models_by_class.get(field.rel.to) in cyclic)
+            plan.append((list(cyclic), deferred_fields))
+        return plan
+
+    def queue_sync(self, full=False):
+        """
+        Queue a sync to run in the background, see start_sync_executor(). Returns the
+        queued SyncRun, or the one already queued for this source.
+        """
+        pending = self.runs.filter(status='queued')
+        run = pending[0] if pending.exists() else \
+            SyncRun.objects.create(source=self, queued=timezone.now(), status='queued', full=full)
+        # also when the executor that would have run the queued one is gone
+        if SYNC_EXECUTOR == 'thread':
+            start_sync_executor()
+        return run
+
+    def sync(self, full=False, workers=1, run=None):
+        """
+        Sync all active models from this source, see get_sync_plan(). Models in the
+        same level are synced on up to workers threads. Progress and the outcome are
+        recorded in run, a new SyncRun unless given. Returns False without syncing
+        when another sync of this source holds the lock - run is then queued again.
+        """
+        self._lock_owner = '%s:%d:%s' % (socket.gethostname(), os.getpid(), uuid.uuid4().hex[:8])
+        if not self.acquire_lock(self._lock_owner):
+            if run is not None:
+                run.requeue()
+            return False
+        try:
+            self._sync(full, workers, run)
+        finally:
+            self.close_session()
+            self.release_lock(self._lock_owner)
+        return True
 
-    def sync(self):
-        # published resources
-        response = self.request()
+    def _sync(self, full, workers, run=None):
+        if run is None:
+            run = SyncRun.objects.create(source=self, started=timezone.now(), status='running', full=full)
+        try:
+            self._sync_models(run, full, workers)
+        except Exception, e:
+            self.last_sync = timezone.now()
+            self.last_sync_message = ('Exception: %s' % e)[:200]
+            self.save_sync_status()
+        run.finish('success' if self.last_sync_message == 'Success' else 'failed', self.last_sync_message)
+        self.schedule_next(run.status == 'success')
+        # history
+        old = self.runs.exclude(status='queued').order_by('-started').values_list('pk', flat=True)[SYNC_HISTORY:]
+        SyncRun.objects.filter(pk__in=list(old)).delete()
+        sync_finished.send(sender=self.__class__, run=run)
+
+    def _sync_models(self, run, full, workers):
+        # published resources, unless the index didn't change since the last run
+        headers = None if full else conditional_headers(self.index_etag, self.index_last_modified)
+        try:
+            response = self.request(headers=headers)
+        except requests.exceptions.RequestException, e:
+            self.last_sync = timezone.now()
+            self.last_sync_message = ('Exception: %s' % e)[:200]
+            self.save_sync_status()
+            return
         if not response.ok:
             self.last_sync = timezone.now()
             self.last_sync_message = '%d' % response.status_code
-            super(DistributedSource, self).save()
+            self.save_sync_status()
             return
-        data = response.json()
-        order = self.models.all().aggregate(Max('order'))['order__max'] or 0
-        for resource in data.keys():
-            if not self.models.filter(api_url=resource).exists():
-                order += 1
-                DistributedSourceModel.objects.create(
-                    source = self,
-                    resource_name = resource,
-                    api_url = resource,
-                    order = order,
-                )
+        if response.status_code != 304:
+            data = response.json()
+            for resource in data.keys():
+                if not self.models.filter(api_url=resource).exists():
+                    DistributedSourceModel.objects.create(
+                        source = self,
+                        resource_name = resource,
+                        api_url = resource,
+                    )
+            self.index_etag = response.headers.get('ETag')
+            self.index_last_modified = response.headers.get('Last-Modified')
         # sync
-        for model in self.models.filter(active=True).order_by('order'):
-            model.sync()
+        source_models = list(self.models.filter(active=True))
+        for model in source_models:
+            # share this instance, and with it the pooled session
+            model.source = self
+        SyncRun.objects.filter(pk=run.pk).update(models_total=len(source_models))
+        resolver = ForeignKeyResolver()
+
+        def sync_model(model, deferred_fields):
+            try:
+                model.sync(full=full, deferred_fields=deferred_fields.get(model, ()), resolver=resolver, run=run)
+            finally:
+                SyncRun.objects.filter(pk=run.pk).update(models_done=F('models_done') + 1)
+
+        for level, deferred_fields in self.get_sync_plan(source_models):
+            results = run_in_threads(lambda model: sync_model(model, deferred_fields), level, workers)
+            for model, result, exception in results:
+                if isinstance(exception, SyncLockLost):
+                    raise exception
+            for model in level:
+                if model.deferred_references:
+                    model.resolve_deferred(resolver)
+            self.renew_lock()
         # done
         self.last_sync = timezone.now()
         self.last_sync_message = 'Success'
-        super(DistributedSource, self).save()
+        self.save_sync_status()
 
 
 
@@ -189,12 +749,29 @@ class DistributedSourceModel(models.Model):
     resource_name             = models.CharField(max_length=50,       null=False, blank=False)
     api_url                   = models.CharField(max_length=200,      null=True,  blank=True)
     active                    = models.BooleanField(                  null=False, blank=False,    default=False)
-    order                     = models.PositiveSmallIntegerField(     null=False, blank=False,    default=0)
     last_sync                 = models.DateTimeField(                 null=True,  editable=False)
     last_sync_message         = models.CharField(max_length=200,      null=True,  editable=False)
+    sync_watermark_date       = models.DateTimeField(                 null=True,  editable=False)
+    sync_watermark_uuid       = models.CharField(max_length=32,       null=True,  editable=False)
+    sync_etag                 = models.CharField(max_length=200,      null=True,  editable=False)
+    sync_last_modified        = models.CharField(max_length=50,       null=True,  editable=False)
+    checkpoint_url            = models.TextField(                     null=True,  editable=False)
+    checkpoint_date           = models.DateTimeField(                 null=True,  editable=False)
+    checkpoint_uuid           = models.CharField(max_length=32,       null=True,  editable=False)
+    skipped_runs              = models.PositiveIntegerField(          null=False, editable=False, default=0)
+    shards                    = models.PositiveIntegerField(          null=False, blank=False,    default=1, help_text=_('Full syncs are split into this many uuid ranges, synced by a pool of processes - only when run single threaded, e.g. sync_remote without --daemon and with one worker'))
+
+    deferred_references = ()
+    # set by get_list(): a 304 came back, the (ETag, Last-Modified) of a single page list, and
+    # the url of the page the last record came from
+    not_modified = False
+    response_validators = None
+    page_url = None
+    # set by write_batches(), see there
+    committed_key = None
 
     class Meta:
-        ordering = ('order',)
+        ordering = ('resource_name',)
 
     def __unicode__(self):
         return '%s: %s' % (self.source, self.resource_name)
@@ -212,50 +789,766 @@ class DistributedSourceModel(models.Model):
         module = '.'.join(path[:-1])
         return models.get_model(module, path[-1])
         
-    def get_list(self):
-        data = []
-        response = self.source.request(self.api_url)
-        if not response.ok:
+    def get_watermark(self):
+        """ Return the (modified_date, uuid) of the newest record committed so far, or None """
+        if not self.sync_watermark_date:
+            return None
+        return (self.sync_watermark_date, self.sync_watermark_uuid or '')
+
+    def get_watermark_params(self, watermark):
+        """ Query parameters asking the source for records newer than the watermark """
+        if not watermark:
+            return None
+        params = {'modified_since': watermark[0].isoformat()}
+        if watermark[1]:
+            params['after_uuid'] = watermark[1]
+        return params
+
+    def set_checkpoint(self, url, key=None):
+        """
+        Record where an interrupted sync resumes: the url of the page being read and the
+        highest (modified_date, uuid) committed so far. Written straight away, outside
+        the save() at the end of the sync.
+        """
+        self.checkpoint_url = url
+        self.checkpoint_date, self.checkpoint_uuid = key or (None, None)
+        DistributedSourceModel.objects.filter(pk=self.pk).update(checkpoint_url=self.checkpoint_url,
+            checkpoint_date=self.checkpoint_date, checkpoint_uuid=self.checkpoint_uuid)
+
+    def get_list(self, params=None, stats=None, headers=None, url=None):
+        """
+        Generator yielding the records of the resource page by page, from url if given (e.g.
+        a checkpoint). headers go with the first request only; a 304 sets not_modified.
+        """
+        url = url or self.api_url
+        self.not_modified = False
+        self.response_validators = None
+        first = True
+        while url:
+            request_headers = {'Accept': accept_header()}
+            if first and headers:
+                request_headers.update(headers)
+            response = self.source.request(url, params=params, stream=True, headers=request_headers)
             try:
-                response.raise_for_status()
-            except requests.exceptions.HTTPError, e:
-                raise requests.exceptions.HTTPError('%s (%s)' % (e.message, self))
-        data = response.json()
-        return data
+                if first and response.status_code == 304:
+                    self.not_modified = True
+                    return
+                if not response.ok:
+                    try:
+                        response.raise_for_status()
+                    except requests.exceptions.HTTPError, e:
+                        raise requests.exceptions.HTTPError('%s (%s)' % (e.message, self))
+                page = get_page(response)
+                self.page_url = response.url
+                for rec in page:
+                    yield rec
+                if stats is not None:
+                    # bytes pulled over the wire, before decompression
+                    stats.bytes_transferred += response.raw.tell() if hasattr(response.raw, 'tell') else len(response.content)
+            finally:
+                response.close()
+            if first and not page.next_url and page.cursor is None:
+                self.response_validators = (response.headers.get('ETag'), response.headers.get('Last-Modified'))
+            first = False
+            if page.next_url:
+                # the next url carries its own query string
+                url, params = page.next_url, None
+            elif page.cursor is not None and page.cursor != (params or {}).get('cursor'):
+                params = dict(params or {}, cursor=page.cursor)
+            else:
+                url = None
+
+    def sync_batch(self, cls, records, resolver=None, stats=None):
+        """
+        Write a batch of unserialized records in one transaction - new and newer ones only,
+        see DistributedManager.bulk_upsert(). Returns the number of records written.
+        """
+        if not records:
+            return 0
+        rec_uuids = set(rec['uuid'] for rec in records)
+        queryset = cls.objects.all_with_deleted().filter(uuid__in=list(rec_uuids))
+        unchanged = {}
+        if CONTENT_HASH:
+            stored = dict((uuid_hex(rec_uuid), (pk, content_hash)) for rec_uuid, pk, content_hash in
+                queryset.filter(content_hash__isnull=False).values_list('uuid', 'pk', 'content_hash'))
+            digests = {}
+            for rec in records:
+                if rec['uuid'] in stored:
+                    digests.setdefault(rec['uuid'], set()).add(content_digest(cls, rec))
+            for rec_uuid, (pk, content_hash) in stored.items():
+                if digests[rec_uuid] == set([content_hash]):
+                    unchanged[rec_uuid] = pk
+            if unchanged:
+                queryset = queryset.exclude(pk__in=unchanged.values())
+        pk_name = cls._meta.pk.attname
+        if cls.objects.native_upsert():
+            # the same rules, applied by the database
+            objs, keys = [], set()
+            for rec in records:
+                if rec['uuid'] in unchanged:
+                    continue
+                obj = cls(distributed_source=self.source)
+                for key in rec.keys():
+                    if key != pk_name:
+                        setattr(obj, key, rec[key])
+                objs.append(obj)
+                keys.update(rec.keys())
+            fields = [field.name for field in cls._meta.local_fields if field.attname in keys and field.attname != pk_name]
+            inserted, updated = cls.objects.bulk_upsert(objs, fields)
+            if resolver is not None:
+                for rec_uuid, pk in queryset.values_list('uuid', 'pk'):
+                    resolver.add(cls, rec_uuid, pk)
+                for rec_uuid, pk in unchanged.items():
+                    resolver.add(cls, rec_uuid, pk)
+            if stats is not None:
+                stats.records_inserted += len(inserted)
+                stats.records_updated += len(updated)
+            return len(inserted) + len(updated)
+        existing = {}
+        if len(unchanged) < len(rec_uuids):
+            existing = dict((uuid_hex(obj.uuid), obj) for obj in queryset)
+        created, updated, updated_uuids = [], [], set()
+        for rec in records:
+            if rec['uuid'] in unchanged:
+                continue
+            obj = existing.get(rec['uuid'])
+            if obj is None:
+                obj = cls(uuid=rec['uuid'])
+                obj.distributed_source = self.source
+                existing[rec['uuid']] = obj
+                created.append(obj)
+            else:
+                # like bulk_upsert(), rows of models without modified_date are always written
+                current, modified_date = getattr(obj, 'modified_date', None), rec.get('modified_date')
+                if current and (modified_date is None or modified_date < current or
+                                (modified_date == current and not CONTENT_HASH)):
+                    continue
+                # the same uuid may appear more than once in a batch
+                if obj.pk and rec['uuid'] not in updated_uuids:
+                    updated_uuids.add(rec['uuid'])
+                    updated.append(obj)
+            for key in rec.keys():
+                # primary keys are local to each system
+                if key != pk_name:
+                    setattr(obj, key, rec[key])
+        if CONTENT_HASH:
+            # save() sets it for the updated rows
+            for obj in created:
+                obj.content_hash = obj.get_content_hash()
+        with transaction.atomic():
+            cls.objects.bulk_create(created)
+            log_changes(cls, 'save', [obj.uuid for obj in created if not obj.date_deleted])
+            log_changes(cls, 'delete', [obj.uuid for obj in created if obj.date_deleted])
+            for obj in updated:
+                obj.save(audit=False)
+        if resolver is not None:
+            for obj in existing.values():
+                if obj.pk:
+                    resolver.add(cls, obj.uuid, obj.pk)
+            for rec_uuid, pk in unchanged.items():
+                resolver.add(cls, rec_uuid, pk)
+            # bulk_create doesn't set the pks
+            if created:
+                for rec_uuid, pk in cls.objects.all_with_deleted().filter(
+                        uuid__in=[obj.uuid for obj in created]).values_list('uuid', 'pk'):
+                    resolver.add(cls, rec_uuid, pk)
+        if stats is not None:
+            stats.records_inserted += len(created)
+            stats.records_updated += len(updated)
+        return len(created) + len(updated)
+
+    def resolve_deferred(self, resolver=None):
+        """ Set the foreign keys that were deferred during sync, now that the related rows exist """
+        cls = self.get_model_class()
+        resolver = resolver or ForeignKeyResolver()
+        by_field = {}
+        for rec_uuid, field_name, related_uuid in self.deferred_references:
+            by_field.setdefault(field_name, []).append((rec_uuid, related_uuid))
+        missing = 0
+        for field_name, references in by_field.items():
+            related_model = cls._meta.get_field(field_name).rel.to
+            resolver.prefetch(related_model, [related_uuid for rec_uuid, related_uuid in references])
+            with transaction.atomic():
+                for rec_uuid, related_uuid in references:
+                    pk = resolver.get(related_model, related_uuid)
+                    if pk is None:
+                        missing += 1
+                        continue
+                    values = dict(stale_content_hash(cls), **{field_name: pk})
+                    if cls.objects.all_with_deleted().filter(uuid=rec_uuid).update(**values):
+                        log_changes(cls, 'save', [rec_uuid])
+        self.deferred_references = ()
+        if missing:
+            self.last_sync_message = ('%s - %d unresolved references' % (self.last_sync_message, missing))[:200]
+            self.save()
+
+    def apply_push(self, records):
+        """
+        Write records pushed by the source, through the same unserialize_json_list() and
+        sync_batch() as a pull sync - by uuid and modified_date, so a batch applied twice
+        changes nothing. Records referring to rows that don't exist are skipped; the next
+        pull sync fetches them. The watermark is left alone. Returns (records written,
+        records skipped).
+        """
+        cls = self.get_model_class()
+        if not cls:
+            raise ValueError('Model %s not defined in settings.DISTRIBUTED_MODELS' % self.resource_name)
+        resolver = ForeignKeyResolver()
+        missing = []
+        total = 0
+        for batch in chunked(records, SYNC_BATCH_SIZE):
+            batch = unserialize_json_list(batch, cls, resolver, missing=missing)
+            total += self.sync_batch(cls, batch, resolver)
+        return total, len(missing)
+
+    def write_batches(self, cls, object_list, resolver, stats, missing, run=None, watermark=None, high=None,
+                      deferred_fields=(), checkpoint=False):
+        """
+        Parse and write the records of object_list in batches of SYNC_BATCH_SIZE, skipping
+        those at or below watermark. With checkpoint, a checkpoint follows every batch.
+        committed_key is the highest (modified_date, uuid) written so far. Returns
+        (records written, highest (modified_date, uuid) seen - or high).
+        """
+        total = 0
+        self.committed_key = None
+        object_list = stats.iterate(object_list, 'fetch')
+        for batch in chunked(object_list, SYNC_BATCH_SIZE):
+            stats.records_seen += len(batch)
+            if run is not None:
+                SyncRun.objects.filter(pk=run.pk).update(records_processed=F('records_processed') + len(batch))
+            records = []
+            with stats.phase('parse'):
+                batch = unserialize_json_list(batch, cls, resolver, deferred_fields, self.deferred_references, missing, stats)
+            for rec in batch:
+                rec_key = (rec.get('modified_date'), rec['uuid'])
+                # already committed by a previous run
+                if watermark and rec_key[0] and rec_key <= watermark:
+                    continue
+                records.append(rec)
+                if rec_key[0] and (not high or rec_key > high):
+                    high = rec_key
+            self.source.renew_lock()
+            with stats.phase('write'):
+                total += self.sync_batch(cls, records, resolver, stats)
+                self.committed_key = high
+                # a resume after a skipped record would never fetch it again
+                if checkpoint and not missing:
+                    self.set_checkpoint(self.page_url, high)
+            stats.collect_queries()
+        return total, high
+
+    def sync_shard(self, uuid_range, run=None):
+        """
+        Sync the records with a uuid in uuid_range (see utils.uuid_ranges), one shard of
+        sync_shards(). Returns (records written, highest (modified_date, uuid), missing
+        references, stats counters, error). When the shard fails, error is its message and
+        the highest (modified_date, uuid) is the committed_key it got to.
+        """
+        cls = self.get_model_class()
+        params = {}
+        if uuid_range[0]:
+            params['uuid_gte'] = uuid_range[0]
+        if uuid_range[1]:
+            params['uuid_lt'] = uuid_range[1]
+        stats = SyncStats(connections[router.db_for_write(cls)])
+        missing = []
+        try:
+            total, high = self.write_batches(cls, self.get_list(params, stats), ForeignKeyResolver(), stats, missing, run)
+        except SyncLockLost:
+            raise
+        except Exception, e:
+            stats.close()
+            return 0, self.committed_key, missing, stats.counters(), '%s' % e
+        stats.close()
+        return total, high, missing, stats.counters(), None
 
-    def sync(self):
+    def sync_shards(self, stats, missing, run=None):
+        """
+        Sync all records in shards uuid ranges, each fetched, parsed and written by one of
+        a pool of up to one process per CPU with its own database connections. The
+        counters of the shards are added to stats and their missing references to
+        missing. Returns (records written, highest (modified_date, uuid)).
+
+        The pool forks this process, which must be single threaded - a thread holding a
+        lock (logging, a connection pool, a ForeignKeyResolver) at the fork would leave it
+        held in the children - so sync() only shards when no other thread runs, and the
+        daemon, the admin executor and --source-workers sync on one process instead.
+
+        Each shard reads its records in (modified_date, uuid) order. When a shard fails,
+        every record up to the lowest key the failed shards committed is written, so a
+        checkpoint there lets the next sync resume on a single process.
+        """
+        self.not_modified, self.response_validators = False, None
+        # the processes must not share the connections of this one
+        for connection in connections.all():
+            connection.close()
+        pool = multiprocessing.Pool(min(self.shards, multiprocessing.cpu_count()))
+        try:
+            owner = getattr(self.source, '_lock_owner', None)
+            results = pool.map(sync_shard, [(self.pk, uuid_range, run.pk if run else None, owner)
+                                            for uuid_range in uuid_ranges(self.shards)])
+        finally:
+            pool.close()
+            pool.join()
+        total, high, errors, committed = 0, None, [], []
+        for shard_total, shard_high, shard_missing, counters, error in results:
+            total += shard_total
+            missing.extend(shard_missing)
+            stats.merge(counters)
+            if error:
+                errors.append(error)
+                committed.append(shard_high)
+            elif shard_high and (not high or shard_high > high):
+                high = shard_high
+        if errors:
+            committed = None if None in committed else min(committed)
+            # a resume after a skipped record would never fetch it again
+            if committed and not missing:
+                self.set_checkpoint('%s?%s' % (self.api_url, urlencode(self.get_watermark_params(committed))), committed)
+            raise Exception('%d of %d shards failed, e.g. %s' % (len(errors), self.shards, errors[0]))
+        return total, high
+
+    def sync(self, full=False, deferred_fields=(), resolver=None, run=None):
+        """
+        Sync the records newer than the watermark from the source - all of them with full.
+        Batches are written and checkpointed by write_batches(), initial loads of models
+        with shards by sync_shards(); skipped records hold the watermark back, see
+        hold_watermark(). Foreign keys in deferred_fields are fixed up by
+        resolve_deferred(). Recorded in a SyncModelRun, part of run if given.
+        """
         total = 0
+        model_run = SyncModelRun(run=run, source_model=self, started=timezone.now())
         # model
         cls = self.get_model_class()
         if not cls:
             self.last_sync = timezone.now()
             self.last_sync_message = 'Failed - model not defined in settings.DISTRIBUTED_MODELS'
             self.save()
+            model_run.finish(self.last_sync_message)
             return
+        watermark = None if full else self.get_watermark()
+        high = watermark
+        checkpoint = not deferred_fields
+        resume = None
+        if checkpoint and not full and self.checkpoint_url:
+            # an earlier sync failed part way
+            resume = self.checkpoint_url
+            if self.checkpoint_date:
+                high = (self.checkpoint_date, self.checkpoint_uuid or '')
+        elif self.checkpoint_url:
+            self.set_checkpoint(None)
+        # large initial loads - models with deferred_fields need all their rows in one place, and
+        # only a single threaded process may fork, see sync_shards()
+        sharded = self.shards > 1 and not deferred_fields and not resume and not watermark and \
+            threading.active_count() == 1
+        resolver = resolver or ForeignKeyResolver()
+        stats = SyncStats(connections[router.db_for_write(cls)])
+        self.deferred_references = []
+        missing = []
+        lost = None
         try:
             # list
-            object_list = self.get_list()
-            for rec in object_list:
-                rec = unserialize_json(rec, cls)
-                if not cls.objects.all_with_deleted().filter(uuid=rec['uuid']).exists():
-                    obj = cls(uuid=rec['uuid'])
-                    obj.distributed_source = self.source
+            if sharded:
+                total, high = self.sync_shards(stats, missing, run)
+            else:
+                if resume:
+                    object_list = self.get_list(stats=stats, url=resume)
                 else:
-                    obj = cls.objects.get(uuid=rec['uuid'])
-                # all fields
-                if (not obj.modified_date) or (obj.modified_date < rec['modified_date']):
-                    for key in rec.keys():
-                        setattr(obj, key, rec[key])
-                    obj.save(audit=False)
-                    total += 1
-            # done
+                    headers = None if full else conditional_headers(self.sync_etag, self.sync_last_modified)
+                    object_list = self.get_list(self.get_watermark_params(watermark), stats, headers)
+                total, high = self.write_batches(cls, object_list, resolver, stats, missing, run, watermark, high,
+                                                 deferred_fields, checkpoint)
+            # done - only advance the watermark once everything is committed
+            given_up = False
+            if missing:
+                held, given_up = self.hold_watermark(watermark, high, missing)
+                high = high if given_up else held
+            else:
+                self.skipped_runs = 0
+            if high:
+                self.sync_watermark_date, self.sync_watermark_uuid = high
+            self.checkpoint_url, self.checkpoint_date, self.checkpoint_uuid = None, None, None
             self.last_sync = timezone.now()
-            self.last_sync_message = 'Synced %d objects' % total
+            if self.not_modified:
+                self.last_sync_message = 'Not modified'
+            else:
+                self.last_sync_message = 'Synced %d objects%s' % (total, ' (resumed)' if resume else
+                                                                  ' in %d shards' % self.shards if sharded else '')
+                # a later page or a skipped record may change without the first page changing
+                validators = self.response_validators if not missing and not resume and not sharded else None
+                self.sync_etag, self.sync_last_modified = validators or (None, None)
+            if missing:
+                self.last_sync_message = ('%s - %s %d with missing references, e.g. %s %s' % (
+                    self.last_sync_message, 'gave up on' if given_up else 'skipped', len(missing),
+                    missing[0][1], missing[0][2]))[:200]
         except Exception, e:
             self.last_sync = timezone.now()
             self.last_sync_message = 'Exception: %s' % e
+            self.sync_etag, self.sync_last_modified = None, None
+            lost = e if isinstance(e, SyncLockLost) else None
+        stats.close()
+        self.save()
+        model_run.finish(self.last_sync_message, stats)
+        if lost is not None:
+            # the rest of the source sync must stop too
+            raise lost
+
+    def hold_watermark(self, watermark, high, missing):
+        """
+        The watermark after a sync that skipped the missing records: just below the oldest
+        of them, so the next sync fetches them again - but not behind watermark or beyond
+        high. skipped_runs counts the syncs in a row that didn't get past them; after
+        SYNC_SKIPPED_RUNS they are given up. Returns (watermark, given up).
+        """
+        dates = [modified_date for rec_uuid, name, value, modified_date in missing if modified_date]
+        held = high
+        if dates:
+            # without after_uuid the source sends every record from modified_since on
+            held = (min(dates), '')
+            if watermark and held < watermark:
+                held = watermark
+            if high and high < held:
+                held = high
+        if held and held == watermark:
+            self.skipped_runs += 1
+        else:
+            self.skipped_runs = 1
+        if self.skipped_runs > SYNC_SKIPPED_RUNS:
+            self.skipped_runs = 0
+            return held, True
+        return held, False
+
+    def get_digest(self, prefix, rows=False):
+        """ The source's bucket_digests() under prefix, or with rows its reconcile_row()s """
+        params = {'prefix': prefix}
+        if rows:
+            params['rows'] = 1
+        response = self.source.request(self.api_url.rstrip('/') + '/digest', params=params)
+        try:
+            response.raise_for_status()
+        except requests.exceptions.HTTPError, e:
+            raise requests.exceptions.HTTPError('%s (%s)' % (e.message, self))
+        return response.json()
+
+    def reconcile(self):
+        """
+        Anti-entropy check against the source, for records that were deleted there without
+        a trace the sync would pick up, or that drifted. Both sides hash their rows into
+        buckets by uuid prefix; only buckets whose digests differ are split further, and
+        the rows of a bucket are compared once the source has RECONCILE_LEAF_SIZE or
+        fewer in it. Local rows synced from this source that the source doesn't have,
+        or has deleted, are marked deleted along with their related rows. Rows whose
+        modified_date differs are only counted - the next full sync fixes them.
+        Returns {'deleted': rows marked deleted, 'drifted': rows that differ,
+        'requests': digest requests made}.
+        """
+        cls = self.get_model_class()
+        if not cls:
+            raise ValueError('Model %s not defined in settings.DISTRIBUTED_MODELS' % self.resource_name)
+        result = {'deleted': 0, 'drifted': 0, 'requests': 0}
+        absent = []
+        pending = ['']
+        while pending:
+            prefix = pending.pop()
+            remote = self.get_digest(prefix)['buckets']
+            result['requests'] += 1
+            # rows the source holds that were not synced from it only make buckets differ
+            local = cls.objects.bucket_digests(prefix, distributed_source=self.source)
+            for bucket, (count, digest) in local.items():
+                remote_count, remote_digest = remote.get(bucket, (0, None))
+                if digest == remote_digest:
+                    continue
+                if not remote_count:
+                    absent.extend(row[0] for row in cls.objects.reconcile_rows(bucket, distributed_source=self.source) if not row[2])
+                elif remote_count > RECONCILE_LEAF_SIZE and len(bucket) < 32:
+                    pending.append(bucket)
+                else:
+                    remote_rows = dict((row[0], row) for row in self.get_digest(bucket, rows=True)['rows'])
+                    result['requests'] += 1
+                    for row in cls.objects.reconcile_rows(bucket, distributed_source=self.source):
+                        remote_row = remote_rows.get(row[0])
+                        if row[2]:
+                            continue
+                        elif remote_row is None or remote_row[2]:
+                            absent.append(row[0])
+                        elif remote_row[1] != row[1]:
+                            result['drifted'] += 1
+        for chunk in chunked(absent, SYNC_BATCH_SIZE):
+            result['deleted'] += cls.objects.filter(uuid__in=chunk).delete().get(cls, 0)
+        return result
+
+
+
+
+def sync_shard(args):
+    """ multiprocessing worker of DistributedSourceModel.sync_shards() """
+    pk, uuid_range, run_pk, lock_owner = args
+    source_model = DistributedSourceModel.objects.select_related('source').get(pk=pk)
+    # renewing the lock of the sync in the parent process
+    source_model.source._lock_owner = lock_owner
+    try:
+        return source_model.sync_shard(uuid_range, SyncRun(pk=run_pk) if run_pk else None)
+    finally:
+        source_model.source.close_session()
+        for connection in connections.all():
+            connection.close()
+
+
+
+class SyncRunManager(models.Manager):
+    def claim_next(self, exclude_sources=()):
+        """
+        Take the oldest queued run by moving it to running with a conditional UPDATE, so
+        every queued run is picked up once. Runs of the sources with a pk in exclude_sources
+        are left. Returns the run, or None when none are queued.
+        """
+        queryset = self.filter(status='queued').exclude(source__in=list(exclude_sources))
+        for pk in queryset.order_by('queued').values_list('pk', flat=True)[:10]:
+            if self.filter(pk=pk, status='queued').update(status='running', started=timezone.now()):
+                return self.get(pk=pk)
+        return None
+
+
+
+class SyncRun(models.Model):
+    """
+    History of DistributedSource syncs, and the queue of syncs waiting to run
+    """
+    STATUS_CHOICES = (
+        ('queued', 'Queued'),
+        ('running', 'Running'),
+        ('success', 'Success'),
+        ('failed', 'Failed'),
+    )
+    source                    = models.ForeignKey(DistributedSource,  null=False, editable=False, related_name='runs')
+    queued                    = models.DateTimeField(                 null=True,  editable=False)
+    started                   = models.DateTimeField(                 null=True,  editable=False)
+    finished                  = models.DateTimeField(                 null=True,  editable=False)
+    status                    = models.CharField(max_length=20,       null=False, editable=False, choices=STATUS_CHOICES)
+    message                   = models.CharField(max_length=200,      null=True,  editable=False)
+    full                      = models.BooleanField(                  null=False, editable=False, default=False)
+    models_total              = models.PositiveIntegerField(          null=False, editable=False, default=0)
+    models_done               = models.PositiveIntegerField(          null=False, editable=False, default=0)
+    records_processed         = models.PositiveIntegerField(          null=False, editable=False, default=0)
+
+    objects = SyncRunManager()
+
+    class Meta:
+        ordering = ('-started',)
+
+    def __unicode__(self):
+        return '%s: %s' % (self.source, self.started or self.queued)
+
+    def duration(self):
+        if not self.finished or not self.started:
+            return None
+        return (self.finished - self.started).total_seconds()
+
+    def requeue(self):
+        """ Put a claimed run back in the queue, e.g. while another sync holds the lock of the source """
+        self.status, self.started = 'queued', None
+        self.save(update_fields=('status', 'started'))
+
+    def finish(self, status, message):
+        self.finished = timezone.now()
+        self.status = status
+        self.message = (message or '')[:200]
+        # the progress counters are updated in the database meanwhile
+        self.save(update_fields=('finished', 'status', 'message'))
+
+    def progress(self):
+        """ Progress for the admin change page, see DistributedSourceAdmin.progress_view() """
+        return {
+            'status': self.status,
+            'message': self.message or '',
+            'models_total': self.models_total,
+            'models_done': self.models_done,
+            'records_processed': self.records_processed,
+            'duration': self.duration() if self.finished else
+                        (timezone.now() - self.started).total_seconds() if self.started else None,
+        }
+
+
+
+def run_queued_syncs():
+    """
+    Run queued syncs one after the other until none are left but those of sources that
+    another sync holds the lock of - they stay queued. Returns the number run.
+    """
+    count, locked = 0, set()
+    while True:
+        run = SyncRun.objects.claim_next(locked)
+        if run is None:
+            return count
+        try:
+            if not run.source.sync(full=run.full, run=run):
+                locked.add(run.source_id)
+                continue
+        except Exception, e:
+            run.finish('failed', 'Exception: %s' % e)
+        count += 1
+
+
+
+# background thread running queued syncs, and when the last sync was queued
+_executor = None
+_executor_queued = 0
+_executor_lock = threading.Lock()
+
+def start_sync_executor():
+    """ Start the background thread running queued syncs in this process, unless it runs already """
+    global _executor, _executor_queued
+    with _executor_lock:
+        _executor_queued = time.time()
+        if _executor is None:
+            _executor = threading.Thread(target=_execute_queued_syncs, name='distributed-sync-executor')
+            _executor.daemon = True
+            _executor.start()
+
+
+
+def _execute_queued_syncs():
+    """
+    Run queued syncs until nothing was queued for SYNC_EXECUTOR_IDLE seconds - runs
+    queued in a request are only visible once its transaction commits - and none wait
+    for the lock of their source.
+    """
+    global _executor
+    try:
+        while True:
+            run_queued_syncs()
+            waiting = SyncRun.objects.filter(status='queued').exists()
+            with _executor_lock:
+                if time.time() - _executor_queued > SYNC_EXECUTOR_IDLE and not waiting:
+                    _executor = None
+                    return
+            time.sleep(1)
+    except Exception:
+        with _executor_lock:
+            _executor = None
+        raise
+    finally:
+        for connection in connections.all():
+            connection.close()
+
+
+
+
+class SyncModelRun(models.Model):
+    """
+    History of DistributedSourceModel syncs, with timings per phase in seconds:
+    fetch (HTTP and JSON), parse (unserialize), resolve (foreign keys) and write.
+    """
+    run                       = models.ForeignKey(SyncRun,            null=True,  editable=False, related_name='model_runs')
+    source_model              = models.ForeignKey(DistributedSourceModel, null=False, editable=False, related_name='runs')
+    started                   = models.DateTimeField(                 null=False, editable=False)
+    finished                  = models.DateTimeField(                 null=True,  editable=False)
+    message                   = models.CharField(max_length=200,      null=True,  editable=False)
+    fetch_time                = models.FloatField(                    null=False, editable=False, default=0)
+    parse_time                = models.FloatField(                    null=False, editable=False, default=0)
+    resolve_time              = models.FloatField(                    null=False, editable=False, default=0)
+    write_time                = models.FloatField(                    null=False, editable=False, default=0)
+    bytes_transferred         = models.BigIntegerField(               null=False, editable=False, default=0)
+    records_seen              = models.PositiveIntegerField(          null=False, editable=False, default=0)
+    records_inserted          = models.PositiveIntegerField(          null=False, editable=False, default=0)
+    records_updated           = models.PositiveIntegerField(          null=False, editable=False, default=0)
+    records_skipped           = models.PositiveIntegerField(          null=False, editable=False, default=0)
+    query_count               = models.PositiveIntegerField(          null=False, editable=False, default=0)
+    query_time                = models.FloatField(                    null=False, editable=False, default=0)
+
+    class Meta:
+        ordering = ('-started',)
+
+    def __unicode__(self):
+        return '%s: %s' % (self.source_model, self.started)
+
+    def finish(self, message, stats=None):
+        """ Save the outcome and stats of the sync """
+        self.finished = timezone.now()
+        self.message = message[:200]
+        if stats is not None:
+            for phase in stats.phases:
+                setattr(self, '%s_time' % phase, stats.times[phase])
+            self.bytes_transferred = stats.bytes_transferred
+            self.records_seen = stats.records_seen
+            self.records_inserted = stats.records_inserted
+            self.records_updated = stats.records_updated
+            self.records_skipped = stats.records_seen - stats.records_inserted - stats.records_updated
+            self.query_count = stats.query_count
+            self.query_time = stats.query_time
         self.save()
+        sync_model_finished.send(sender=self.__class__, model_run=self)
+
+    def summary(self):
+        return '%d seen, %d new, %d updated in %.1fs (fetch %.1f, parse %.1f, resolve %.1f, write %.1f), %d KB, %d queries' % (
+            self.records_seen, self.records_inserted, self.records_updated,
+            (self.finished - self.started).total_seconds() if self.finished else 0,
+            self.fetch_time, self.parse_time, self.resolve_time, self.write_time,
+            self.bytes_transferred / 1024, self.query_count)
+
+
+class ChangeLogManager(models.Manager):
+    def since(self, sequence=0, limit=1000, models=None, before=None):
+        """
+        Up to limit entries after sequence, oldest first - a reader tails the log by passing
+        in the pk of the last entry it got, optionally only for models ('app_label.Model').
+        With concurrent writers an entry may commit after one with a higher sequence; with
+        before, the entries stop at the first one logged after it, so a reader that stays
+        far enough behind never passes an entry that is yet to commit.
+        """
+        queryset = self.get_query_set().filter(pk__gt=sequence)
+        if models is not None:
+            queryset = queryset.filter(model__in=models)
+        entries = list(queryset.order_by('pk')[:limit])
+        if before is not None:
+            for i, entry in enumerate(entries):
+                if entry.date > before:
+                    return entries[:i]
+        return entries
 
+    def compact(self, before=None):
+        """
+        Delete every entry but the latest of each row, only among the entries up to sequence
+        before if given. Readers behind still see the current state of every row they missed.
+        Returns the number of entries deleted.
+        """
+        queryset = self.get_query_set()
+        if before is not None:
+            queryset = queryset.filter(pk__lte=before)
+        seen, stale = set(), []
+        for pk, model, row_uuid in queryset.order_by('-pk').values_list('pk', 'model', 'uuid').iterator():
+            if (model, row_uuid) in seen:
+                stale.append(pk)
+            else:
+                seen.add((model, row_uuid))
+        for chunk in chunked(stale, SYNC_BATCH_SIZE):
+            self.get_query_set().filter(pk__in=chunk).delete()
+        return len(stale)
+
+
+
+class ChangeLogEntry(models.Model):
+    """
+    A save, delete or undelete of a DistributedMixin row, appended in the same transaction
+    (see log_changes). The pk is the sequence number.
+    """
+    ACTION_CHOICES = (
+        ('save', _('Saved')),
+        ('delete', _('Deleted')),
+        ('undelete', _('Undeleted')),
+    )
+    model                     = models.CharField(max_length=100,      null=False, editable=False, verbose_name=_('Model'))
+    uuid                      = models.CharField(max_length=32,       null=False, editable=False, verbose_name='UUID')
+    action                    = models.CharField(max_length=10,       null=False, editable=False, choices=ACTION_CHOICES)
+    date                      = models.DateTimeField(                 null=False, editable=False)
+
+    objects = ChangeLogManager()
+
+    class Meta:
+        ordering = ('pk',)
+
+    def __unicode__(self):
+        return '%d %s %s %s' % (self.pk, self.action, self.model, self.uuid)
 
 
 
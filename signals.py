@@ -0,0 +1,8 @@
+from django.dispatch import Signal
+
+
+# sent when a DistributedSource sync finishes, hook for external metrics
+sync_finished = Signal(providing_args=['run'])
+
+# sent when a DistributedSourceModel sync finishes
+sync_model_finished = Signal(providing_args=['model_run'])
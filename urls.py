@@ -0,0 +1,12 @@
+from django.conf.urls import patterns, url
+
+
+# publishing API for other systems' DistributedSources, e.g. url(r'^distributed/', include('distributed.urls'))
+urlpatterns = patterns('distributed.views',
+    url(r'^$', 'index', name='distributed-index'),
+    # peers push changed records here, see DistributedSource.push_url
+    url(r'^push/(?P<source_id>\d+)/(?P<resource>[\w-]+)/?$', 'push', name='distributed-push'),
+    url(r'^(?P<resource>[\w-]+)/digest/?$', 'digest', name='distributed-digest'),
+    # DistributedSourceModel requests the resource without a trailing slash
+    url(r'^(?P<resource>[\w-]+)/?$', 'resource', name='distributed-resource'),
+)
@@ -1,63 +1,764 @@
+import hashlib
+import hmac
+import json
 import requests
 import pytz
+import struct
+import threading
+import time
+import uuid
+from Queue import Queue, Empty
+from collections import OrderedDict
+from contextlib import contextmanager
+from datetime import date, datetime, timedelta
 from decimal import Decimal
-from django.db.models.fields import DateTimeField, DateField, TimeField, DecimalField
+from django.conf import settings
+from django.db import connections
+from django.db.models.fields import DateTimeField, DateField, TimeField, DecimalField, FloatField
 from django.db.models.fields.related import ForeignKey
 from django.utils.dateparse import parse_date, parse_datetime, parse_time
 
+from distributed.fields import UUIDField
+
+try:
+    # incremental JSON parser - records are parsed one at a time instead of loading the whole body
+    import ijson
+except ImportError:
+    ijson = None
+
+try:
+    # compact binary wire format with typed datetimes and decimals, see MSGPACK_DATETIME
+    import msgpack
+except ImportError:
+    msgpack = None
+
+
+# time zone assumed for datetimes that sources send without one
+SOURCE_TIME_ZONE = pytz.timezone(getattr(settings, 'DISTRIBUTED_SOURCE_TIME_ZONE', 'Africa/Johannesburg'))
+
+# model class -> ({field name: converter}, foreign keys), see get_unserialize_plan()
+_unserialize_plans = {}
+
+# wire formats for resource lists - name: content type, see get_page()
+WIRE_CONTENT_TYPES = {
+    'json': 'application/json',
+    'ndjson': 'application/x-ndjson',
+    'msgpack': 'application/x-msgpack',
+}
+# formats requested from sources and offered when publishing, most preferred first
+WIRE_FORMATS = [name for name in getattr(settings, 'DISTRIBUTED_WIRE_FORMATS', ('msgpack', 'ndjson', 'json'))
+                if name != 'msgpack' or msgpack is not None]
+
+# MessagePack extension types: UTC microseconds since the epoch as a signed 64 bit integer, and
+# a decimal as its string
+MSGPACK_DATETIME = 1
+MSGPACK_DECIMAL = 2
+EPOCH = datetime(1970, 1, 1, tzinfo=pytz.utc)
+
+# (model class, typed) -> (values() names, [(values() name, record key, encoder)]), see get_serialize_plan()
+_serialize_plans = {}
+
+# fields that are never published - local bookkeeping
+SERIALIZE_EXCLUDE = ('distributed_source', 'content_hash')
+
+# model class -> [(attname, normalizer)] of the fields covered by content_digest()
+_digest_plans = {}
+
+# fields left out of content digests - identity, local bookkeeping and timestamps peers may touch
+DIGEST_EXCLUDE = ('uuid', 'content_hash', 'modified_date', 'distributed_source')
+
+# related (model, uuid) -> pk entries kept by a ForeignKeyResolver
+FK_CACHE_SIZE = getattr(settings, 'DISTRIBUTED_FK_CACHE_SIZE', 100000)
+
+# (year, month, day, hour) -> tzinfo of SOURCE_TIME_ZONE at that hour, localize() is slow
+_source_tzinfos = {}
+
 
 
 def json_to_datetime(s):
     """ Convert JSON to time zone aware datetime """
-    dt = parse_datetime(s)
+    if isinstance(s, datetime) and s.tzinfo:
+        # already typed, e.g. by a MessagePack extension type
+        return s
+    dt = None
+    # fast path for 'YYYY-MM-DDTHH:MM:SS' and 'YYYY-MM-DDTHH:MM:SSZ'
+    if len(s) == 19 or (len(s) == 20 and s[19] == 'Z'):
+        try:
+            dt = datetime(int(s[0:4]), int(s[5:7]), int(s[8:10]), int(s[11:13]), int(s[14:16]), int(s[17:19]),
+                          tzinfo=pytz.utc if len(s) == 20 else None)
+        except ValueError:
+            pass
+    if dt is None:
+        dt = parse_datetime(s)
     if not dt.tzinfo:
-        tz = pytz.timezone('Africa/Johannesburg')
-        dt = tz.localize(dt)
+        key = (dt.year, dt.month, dt.day, dt.hour)
+        tzinfo = _source_tzinfos.get(key)
+        if tzinfo is None:
+            if len(_source_tzinfos) > 10000:
+                _source_tzinfos.clear()
+            tzinfo = _source_tzinfos[key] = SOURCE_TIME_ZONE.localize(dt).tzinfo
+        dt = dt.replace(tzinfo=tzinfo)
     return dt
 
 
 
-def unserialize_json(data, model_class):
-    """ Take raw json data and unserialize to be compatible with a Django model """
-    all_fields = model_class._meta.get_all_field_names()
-    for field_name in data.keys():
-        # skip if the model doesn't have that field
-        if not (field_name in all_fields):
+def json_to_date(s):
+    """ Convert JSON to date """
+    if isinstance(s, date):
+        return s
+    if len(s) == 10:
+        try:
+            return date(int(s[0:4]), int(s[5:7]), int(s[8:10]))
+        except ValueError:
+            pass
+    return parse_date(s)
+
+
+
+def uuid_hex(value):
+    """ Normalize a uuid from a record or the database (hex, hyphenated, UUID or 16 bytes) to 32 hex digits """
+    if isinstance(value, basestring) and len(value) == 32:
+        return value.lower()
+    if not value:
+        return value
+    if isinstance(value, uuid.UUID):
+        return value.hex
+    if isinstance(value, (buffer, bytearray)) or len(value) == 16:
+        return uuid.UUID(bytes=str(value)).hex
+    return value.replace('-', '').lower()
+
+
+
+def uuid_bytes(value):
+    """ The 16 bytes of a uuid in any of the forms uuid_hex() takes """
+    return uuid.UUID(hex=uuid_hex(value)).bytes
+
+
+
+def msgpack_default(obj):
+    """ MessagePack packer hook for the types JSON has no place for """
+    if isinstance(obj, datetime):
+        if obj.tzinfo is None:
+            obj = SOURCE_TIME_ZONE.localize(obj)
+        delta = obj - EPOCH
+        return msgpack.ExtType(MSGPACK_DATETIME, struct.pack('>q',
+            (delta.days * 86400 + delta.seconds) * 1000000 + delta.microseconds))
+    if isinstance(obj, Decimal):
+        return msgpack.ExtType(MSGPACK_DECIMAL, str(obj))
+    raise TypeError('Cannot serialize %r' % (obj,))
+
+
+
+def msgpack_ext_hook(code, data):
+    """ MessagePack unpacker hook, the reverse of msgpack_default() """
+    if code == MSGPACK_DATETIME:
+        return EPOCH + timedelta(microseconds=struct.unpack('>q', data)[0])
+    if code == MSGPACK_DECIMAL:
+        return Decimal(data)
+    return msgpack.ExtType(code, data)
+
+
+
+def chunked(iterable, size):
+    """ Yield lists of up to size items from any iterable """
+    chunk = []
+    for item in iterable:
+        chunk.append(item)
+        if len(chunk) >= size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+
+
+def run_in_threads(func, items, workers):
+    """
+    Call func(item) for every item on up to workers threads. Each thread closes its own
+    database connections when it is done. Returns a list of (item, result, exception)
+    tuples in the order of items.
+    """
+    items = list(items)
+    results = [None] * len(items)
+    if workers <= 1 or len(items) <= 1:
+        for i, item in enumerate(items):
+            try:
+                results[i] = (item, func(item), None)
+            except Exception, e:
+                results[i] = (item, None, e)
+        return results
+    queue = Queue()
+    for i, item in enumerate(items):
+        queue.put((i, item))
+
+    def worker():
+        try:
+            while True:
+                try:
+                    i, item = queue.get_nowait()
+                except Empty:
+                    return
+                try:
+                    results[i] = (item, func(item), None)
+                except Exception, e:
+                    results[i] = (item, None, e)
+        finally:
+            for connection in connections.all():
+                connection.close()
+
+    threads = [threading.Thread(target=worker) for n in range(min(workers, len(items)))]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return results
+
+
+
+def dependency_levels(graph):
+    """
+    Topologically sort graph, a dict of node -> set of nodes it depends on. Returns a list
+    of levels, each holding the nodes whose dependencies are all in earlier levels, and the
+    set of nodes that could not be placed because they are in or depend on a cycle.
+    """
+    remaining = dict((node, set(deps) & set(graph.keys())) for node, deps in graph.items())
+    levels = []
+    while remaining:
+        level = [node for node, deps in remaining.items() if not deps]
+        if not level:
+            break
+        levels.append(level)
+        for node in level:
+            del remaining[node]
+        for deps in remaining.values():
+            deps.difference_update(level)
+    return levels, set(remaining.keys())
+
+
+
+class ForeignKeyResolver(object):
+    """
+    Resolves related uuids to primary keys for a whole sync run. Lookups are batched into
+    one uuid__in query per related model and the results kept in a bounded LRU cache.
+    Rows inserted during the run are added with add(). get() and prefetch() expect
+    uuids normalized with uuid_hex().
+    """
+
+    def __init__(self, size=FK_CACHE_SIZE):
+        self.size = size
+        self.cache = OrderedDict()
+        self.lock = threading.Lock()
+
+    def add(self, model, uuid, pk):
+        uuid = uuid_hex(uuid)
+        with self.lock:
+            self.cache.pop((model, uuid), None)
+            self.cache[(model, uuid)] = pk
+            while len(self.cache) > self.size:
+                self.cache.popitem(last=False)
+
+    def get(self, model, uuid):
+        """ Return the cached pk, or None """
+        with self.lock:
+            pk = self.cache.pop((model, uuid), None)
+            if pk is not None:
+                self.cache[(model, uuid)] = pk
+            return pk
+
+    def prefetch(self, model, uuids):
+        """ Load the pks of all uuids that are not cached yet """
+        with self.lock:
+            uncached = set(uuid for uuid in uuids if (model, uuid) not in self.cache)
+        for uuid_chunk in chunked(uncached, 500):
+            for uuid, pk in model.objects.all_with_deleted().filter(uuid__in=uuid_chunk).values_list('uuid', 'pk'):
+                self.add(model, uuid, pk)
+
+
+
+def get_unserialize_plan(model_class):
+    """
+    Return the ({field name: converter}, foreign keys) plan for model_class, building it on
+    first use. Fields without a converter map to None and are copied as they are; foreign
+    keys are a list of (name, attname, related model) and are resolved by uuid.
+    """
+    plan = _unserialize_plans.get(model_class)
+    if plan is None:
+        converters, foreign_keys = {}, []
+        for field in model_class._meta.fields:
+            # datetime before date - DateTimeField is a subclass of DateField
+            if isinstance(field, DecimalField):
+                converter = Decimal
+            elif isinstance(field, DateTimeField):
+                converter = json_to_datetime
+            elif isinstance(field, DateField):
+                converter = json_to_date
+            elif isinstance(field, TimeField):
+                converter = parse_time
+            elif isinstance(field, ForeignKey):
+                foreign_keys.append((field.name, field.attname, field.rel.to))
+                continue
+            else:
+                converter = None
+            converters[field.name] = converter
+        plan = _unserialize_plans[model_class] = (converters, foreign_keys)
+    return plan
+
+
+
+def unserialize_json(data, model_class, resolver=None, deferred_fields=(), deferred=None, missing=None):
+    """
+    Take raw json data and unserialize to be compatible with a Django model. Foreign keys
+    are looked up by uuid and set on their attname (e.g. parent_id) as a pk.
+
+    Foreign keys in deferred_fields that don't resolve yet are set to None and appended to
+    deferred as (uuid, field_name, related uuid) to be fixed up later. Other unresolved
+    foreign keys are appended to missing as (uuid, field_name, related uuid, modified_date)
+    and None is returned, or when no missing list is given the related model's
+    DoesNotExist is raised.
+    """
+    converters, foreign_keys = get_unserialize_plan(model_class)
+    if data.get('uuid'):
+        data['uuid'] = uuid_hex(data['uuid'])
+    if resolver is None:
+        resolver = ForeignKeyResolver()
+        for name, attname, related_model in foreign_keys:
+            if data.get(name):
+                resolver.prefetch(related_model, [uuid_hex(data[name])])
+    for field_name, value in data.items():
+        # skip fields the model doesn't have, fields copied as is and empty values
+        converter = converters.get(field_name)
+        if converter is None or not value:
             continue
-        # skip None
-        if not data[field_name]:
+        data[field_name] = converter(value)
+    # foreign keys - lookup based on uuid
+    unresolved = False
+    for name, attname, related_model in foreign_keys:
+        if name not in data:
             continue
+        value = uuid_hex(data.pop(name))
+        pk = resolver.get(related_model, value) if value else None
+        if value and pk is None:
+            if name in deferred_fields:
+                deferred.append((data['uuid'], name, value))
+            elif missing is None:
+                raise related_model.DoesNotExist('%s matching uuid %s does not exist.' % (related_model.__name__, value))
+            else:
+                missing.append((data['uuid'], name, value, data.get('modified_date')))
+                unresolved = True
+        data[attname] = pk
+    if unresolved:
+        return None
+    return data
+
+
+
+def unserialize_json_list(records, model_class, resolver=None, deferred_fields=(), deferred=None, missing=None, stats=None):
+    """
+    Unserialize a batch of raw json records, see unserialize_json(). Foreign keys of the
+    whole batch are resolved with one query per related model. Records with missing
+    references are left out of the result. The lookups are timed as the 'resolve' phase
+    of stats.
+    """
+    converters, foreign_keys = get_unserialize_plan(model_class)
+    resolver = resolver or ForeignKeyResolver()
+    stats = stats or SyncStats()
+    with stats.phase('resolve'):
+        for name, attname, related_model in foreign_keys:
+            resolver.prefetch(related_model, [uuid_hex(data[name]) for data in records if data.get(name)])
+    result = []
+    for data in records:
+        data = unserialize_json(data, model_class, resolver, deferred_fields, deferred, missing)
+        if data is not None:
+            result.append(data)
+    return result
+
 
-        value = data[field_name]
-        field_class = model_class._meta.get_field_by_name(field_name)[0]
-
-        # decimal
-        if issubclass(DecimalField, field_class.__class__):
-            value = Decimal(value)
-
-        # date
-        elif issubclass(DateField, field_class.__class__):
-            value = parse_date(data[field_name])
-        # time
-        elif issubclass(DateField, field_class.__class__):
-            value = parse_time(data[field_name])
-            # if not timezone aware default to SAST
-            if not value.tzinfo:
-                value = pytz.timezone('Africa/Johannesburg').localize(value)
-        # datetime
-        elif issubclass(DateTimeField, field_class.__class__):
-            value = parse_datetime(data[field_name])
-            # if not timezone aware default to SAST
-            if not value.tzinfo:
-                value = pytz.timezone('Africa/Johannesburg').localize(value)
-
-        # foreign key - lookup based on uuid
-        elif issubclass(ForeignKey, field_class.__class__):
-            value = field_class.related.parent_model.objects.all_with_deleted().get(uuid=data[field_name])
-
-        # done
-        data[field_name] = value
+
+def _encode_isoformat(value):
+    return value.isoformat()
+
+
+
+def get_serialize_plan(model_class, typed=False):
+    """
+    Return the (values() field names, [(values() name, record key, encoder)]) plan that
+    serializes rows of model_class the way unserialize_json() reads them, building it
+    on first use. Foreign keys to models with a uuid are sent as the related uuid,
+    other foreign keys and the primary key are left out. Values without an encoder are
+    sent as they are. typed plans are for MessagePack - datetimes and decimals are left
+    to msgpack_default() and uuids are sent as 16 bytes.
+    """
+    plan = _serialize_plans.get((model_class, typed))
+    if plan is None:
+        uuid_encoder = uuid_bytes if typed else uuid_hex
+        columns = []
+        for field in model_class._meta.fields:
+            if field.primary_key or field.name in SERIALIZE_EXCLUDE:
+                continue
+            if isinstance(field, ForeignKey):
+                related_fields = [f.name for f in field.rel.to._meta.fields]
+                if 'uuid' not in related_fields:
+                    continue
+                columns.append((field.name + '__uuid', field.name, uuid_encoder))
+                continue
+            if field.name == 'uuid' or isinstance(field, UUIDField):
+                encoder = uuid_encoder
+            elif isinstance(field, DateTimeField):
+                encoder = None if typed else _encode_isoformat
+            elif isinstance(field, (DateField, TimeField)):
+                encoder = _encode_isoformat
+            elif isinstance(field, DecimalField):
+                encoder = None if typed else str
+            else:
+                encoder = None
+            columns.append((field.name, field.name, encoder))
+        plan = _serialize_plans[(model_class, typed)] = ([name for name, key, encoder in columns], columns)
+    return plan
+
+
+
+def serialize_values(row, plan):
+    """ Convert a values() row to a record ready for the wire with a plan from get_serialize_plan() """
+    data = {}
+    for name, key, encoder in plan[1]:
+        value = row[name]
+        if value is not None and encoder is not None:
+            value = encoder(value)
+        data[key] = value
     return data
 
 
-    
+def _normalize_datetime(value):
+    if value.tzinfo is not None:
+        value = value.astimezone(pytz.utc)
+    return value.isoformat()
+
+
+
+def _normalize_isoformat(value):
+    return value.isoformat()
+
+
+
+def _normalize_decimal(value):
+    # 1.5 from a source and 1.50 from a decimal column are the same value
+    return str(Decimal(value).normalize())
+
+
+
+def _normalize_float(value):
+    return repr(float(value))
+
+
+
+def get_digest_plan(model_class):
+    """ Return the [(attname, normalizer)] of the fields content_digest() covers for model_class """
+    plan = _digest_plans.get(model_class)
+    if plan is None:
+        plan = []
+        for field in model_class._meta.fields:
+            if field.primary_key or field.name in DIGEST_EXCLUDE:
+                continue
+            if isinstance(field, DateTimeField):
+                normalizer = _normalize_datetime
+            elif isinstance(field, (DateField, TimeField)):
+                normalizer = _normalize_isoformat
+            elif isinstance(field, DecimalField):
+                normalizer = _normalize_decimal
+            elif isinstance(field, FloatField):
+                normalizer = _normalize_float
+            elif isinstance(field, UUIDField):
+                normalizer = uuid_hex
+            else:
+                normalizer = None
+            plan.append((field.attname, normalizer))
+        plan = _digest_plans[model_class] = plan
+    return plan
+
+
+
+def content_digest(model_class, values):
+    """
+    SHA-1 hex digest of the normalized field values of a record, keyed by attname - an
+    unserialized record or the __dict__ of an instance give the same digest for the same
+    content. Fields missing from values count as None. See DIGEST_EXCLUDE.
+    """
+    normalized = []
+    for attname, normalizer in get_digest_plan(model_class):
+        value = values.get(attname)
+        if value is not None and normalizer is not None:
+            value = normalizer(value)
+        normalized.append(value)
+    return hashlib.sha1(json.dumps(normalized, separators=(',', ':'), default=unicode)).hexdigest()
+
+
+def reconcile_row(uuid, modified_date, date_deleted):
+    """
+    The (uuid, modified_date, date_deleted) strings reconciliation compares - datetimes
+    in UTC to the second, as not every database keeps microseconds
+    """
+    return (uuid_hex(uuid),
+            _normalize_datetime(modified_date.replace(microsecond=0)) if modified_date else '',
+            _normalize_datetime(date_deleted.replace(microsecond=0)) if date_deleted else '')
+
+
+
+def bucket_digests(rows, prefix_length):
+    """
+    {uuid prefix of prefix_length: [row count, digest]} of reconcile_row() rows. The digest
+    XORs the SHA-1 of every row, so it doesn't depend on the order of the rows.
+    """
+    buckets = {}
+    for row in rows:
+        bucket = buckets.setdefault(row[0][:prefix_length], [0, 0])
+        bucket[0] += 1
+        bucket[1] ^= int(hashlib.sha1('|'.join(row)).hexdigest(), 16)
+    return dict((prefix, [count, '%040x' % digest]) for prefix, (count, digest) in buckets.items())
+
+
+def uuid_ranges(count):
+    """
+    Split the uuid space into count (lowest, highest excluded) ranges of 32 hex digits on
+    4 digit boundaries, the first starting and the last ending open (None)
+    """
+    count = min(max(count, 1), 0x10000)
+    bounds = [None] + ['%04x' % (i * 0x10000 // count) + '0' * 28 for i in range(1, count)] + [None]
+    return zip(bounds[:-1], bounds[1:])
+
+
+
+def push_signature(secret, body):
+    """ HMAC-SHA256 of a pushed body with the source's push_secret, sent as X-Distributed-Signature """
+    return hmac.new(secret.encode('utf-8'), body, hashlib.sha256).hexdigest()
+
+
+class SyncStats(object):
+    """
+    Timings per phase (fetch, parse, resolve, write) and counters of one model sync.
+    Phases nest - time spent in an inner phase is not counted in the outer one.
+    With a connection, the queries run on it are counted and timed as well.
+    """
+    phases = ('fetch', 'parse', 'resolve', 'write')
+
+    def __init__(self, connection=None):
+        self.times = dict((name, 0.0) for name in self.phases)
+        self.bytes_transferred = 0
+        self.records_seen = 0
+        self.records_inserted = 0
+        self.records_updated = 0
+        self.query_count = 0
+        self.query_time = 0.0
+        self.connection = connection
+        self._stack = []
+        if connection is not None:
+            self._use_debug_cursor = connection.use_debug_cursor
+            connection.use_debug_cursor = True
+            self._query_start = len(connection.queries)
+
+    @contextmanager
+    def phase(self, name):
+        self._stack.append(0.0)
+        start = time.time()
+        try:
+            yield
+        finally:
+            elapsed = time.time() - start
+            inner = self._stack.pop()
+            self.times[name] += elapsed - inner
+            if self._stack:
+                self._stack[-1] += elapsed
+
+    def iterate(self, iterable, name):
+        """ Iterate over iterable, timing the wait for every item as phase name """
+        iterator = iter(iterable)
+        while True:
+            with self.phase(name):
+                try:
+                    item = next(iterator)
+                except StopIteration:
+                    return
+            yield item
+
+    def collect_queries(self):
+        """ Count the queries logged since the last call and drop them from the log """
+        if self.connection is None:
+            return
+        queries = self.connection.queries[self._query_start:]
+        self.query_count += len(queries)
+        self.query_time += sum(float(query['time']) for query in queries)
+        del self.connection.queries[self._query_start:]
+
+    def counters(self):
+        """ The timings and counters as a plain dict, e.g. to send them back from another process """
+        return {
+            'times': dict(self.times),
+            'bytes_transferred': self.bytes_transferred,
+            'records_seen': self.records_seen,
+            'records_inserted': self.records_inserted,
+            'records_updated': self.records_updated,
+            'query_count': self.query_count,
+            'query_time': self.query_time,
+        }
+
+    def merge(self, counters):
+        """ Add the counters() of another sync - the times become totals over all processes """
+        for name, value in counters['times'].items():
+            self.times[name] += value
+        for name, value in counters.items():
+            if name != 'times':
+                setattr(self, name, getattr(self, name) + value)
+
+    def close(self):
+        if self.connection is not None:
+            self.collect_queries()
+            self.connection.use_debug_cursor = self._use_debug_cursor
+            self.connection = None
+
+
+
+class ResponseStream(object):
+    """ File-like wrapper around a streamed (stream=True) response body """
+
+    def __init__(self, response, chunk_size=64 * 1024):
+        self.chunks = response.iter_content(chunk_size)
+        self.buffer = ''
+
+    def _fill(self, size):
+        while size < 0 or len(self.buffer) < size:
+            try:
+                self.buffer += next(self.chunks)
+            except StopIteration:
+                break
+
+    def read(self, size=-1):
+        self._fill(size)
+        if size < 0:
+            data, self.buffer = self.buffer, ''
+        else:
+            data, self.buffer = self.buffer[:size], self.buffer[size:]
+        return data
+
+    def peek(self):
+        """ Return the first non-whitespace character without consuming it """
+        while True:
+            self.buffer = self.buffer.lstrip()
+            if self.buffer:
+                return self.buffer[0]
+            self._fill(1)
+            if not self.buffer:
+                return ''
+
+
+
+class JsonPage(object):
+    """
+    Iterate over the records in one page of a JSON resource. A page is either a plain
+    list of records or a paginated object: {"results": [...], "next": url} or
+    {"results": [...], "cursor": token}. next_url / cursor are set once iteration is done.
+    """
+    content_type = WIRE_CONTENT_TYPES['json']
+
+    def __init__(self, response):
+        self.response = response
+        # a Link: <url>; rel="next" header, the envelope of a JSON page takes precedence
+        self.next_url = response.links.get('next', {}).get('url')
+        self.cursor = None
+
+    def __iter__(self):
+        if ijson is None:
+            return self._iter_buffered()
+        return self._iter_streamed()
+
+    def _iter_buffered(self):
+        data = self.response.json()
+        if isinstance(data, dict):
+            self.next_url = data.get('next')
+            self.cursor = data.get('cursor')
+            data = data.get('results') or []
+        for rec in data:
+            yield rec
+
+    def _iter_streamed(self):
+        stream = ResponseStream(self.response)
+        if stream.peek() == '[':
+            for rec in ijson.items(stream, 'item'):
+                yield rec
+            return
+        builder = None
+        for prefix, event, value in ijson.parse(stream):
+            if builder is not None:
+                builder.event(event, value)
+                if prefix == 'results.item' and event in ('end_map', 'end_array'):
+                    yield builder.value
+                    builder = None
+            elif prefix == 'results.item' and event in ('start_map', 'start_array'):
+                builder = ijson.common.ObjectBuilder()
+                builder.event(event, value)
+            elif prefix == 'next' and event in ('string', 'null'):
+                self.next_url = value
+            elif prefix == 'cursor' and event in ('string', 'number', 'null'):
+                self.cursor = value
+
+
+
+class NdjsonPage(JsonPage):
+    """ One page of a line-delimited JSON resource - a record per line, the next page in the Link header """
+    content_type = WIRE_CONTENT_TYPES['ndjson']
+
+    def __iter__(self):
+        for line in self.response.iter_lines(chunk_size=64 * 1024):
+            if line.strip():
+                yield json.loads(line)
+
+
+
+class MsgpackPage(JsonPage):
+    """ One page of a MessagePack resource - a stream of records, the next page in the Link header """
+    content_type = WIRE_CONTENT_TYPES['msgpack']
+
+    def __iter__(self):
+        unpacker = msgpack.Unpacker(ResponseStream(self.response), raw=False, ext_hook=msgpack_ext_hook)
+        for rec in unpacker:
+            yield rec
+
+
+
+def get_page(response):
+    """ The page class matching the Content-Type of response, JsonPage when unknown """
+    content_type = response.headers.get('Content-Type', '').split(';')[0].strip().lower()
+    if content_type == MsgpackPage.content_type and msgpack is not None:
+        return MsgpackPage(response)
+    if content_type == NdjsonPage.content_type:
+        return NdjsonPage(response)
+    return JsonPage(response)
+
+
+
+def accept_header(formats=None):
+    """ Accept header asking for formats (default WIRE_FORMATS), in order of preference """
+    formats = formats or WIRE_FORMATS
+    return ', '.join('%s;q=%.1f' % (WIRE_CONTENT_TYPES[name], 1 - 0.1 * i) for i, name in enumerate(formats))
+
+
+
+def negotiate_format(accept, formats=None):
+    """ The wire format of formats (default WIRE_FORMATS) the Accept header accept prefers, or 'json' """
+    formats = formats or WIRE_FORMATS
+    accepted = {}
+    for item in (accept or '').split(','):
+        parts = [part.strip() for part in item.split(';')]
+        q = 1.0
+        for param in parts[1:]:
+            if param.startswith('q='):
+                try:
+                    q = float(param[2:])
+                except ValueError:
+                    q = 0.0
+        accepted[parts[0].lower()] = q
+    best, best_q = 'json', 0.0
+    # ties go to the earlier format
+    for name in formats:
+        q = accepted.get(WIRE_CONTENT_TYPES[name], 0.0)
+        if q > best_q:
+            best, best_q = name, q
+    return best
@@ -0,0 +1,280 @@
+import base64
+import hashlib
+import json
+from functools import wraps
+from urllib import urlencode
+from django.conf import settings
+from django.contrib.auth import authenticate
+from django.core.urlresolvers import reverse
+from django.db import models
+from django.db.models import Count, Max, Q
+from django.http import Http404, HttpResponse, HttpResponseBadRequest, HttpResponseForbidden, StreamingHttpResponse
+from django.shortcuts import get_object_or_404
+from django.utils.cache import patch_vary_headers
+from django.utils.crypto import constant_time_compare
+from django.views.decorators.csrf import csrf_exempt
+from django.views.decorators.http import condition, require_POST
+
+from distributed.models import DistributedSource, DistributedSourceModel
+from distributed.utils import (WIRE_CONTENT_TYPES, chunked, get_serialize_plan, json_to_datetime, msgpack, msgpack_default,
+                               negotiate_format, push_signature, serialize_values, uuid_hex)
+
+
+# resource name -> 'app_label.Model' of the models published to peers, defaults to DISTRIBUTED_MODELS
+PUBLISHED_MODELS = getattr(settings, 'DISTRIBUTED_PUBLISHED_MODELS', None)
+# records per page - peers may ask for a different size with ?limit=, up to PUBLISH_MAX_PAGE_SIZE
+PUBLISH_PAGE_SIZE = getattr(settings, 'DISTRIBUTED_PUBLISH_PAGE_SIZE', 1000)
+PUBLISH_MAX_PAGE_SIZE = 10000
+# usernames of the peers that may read the published models without the distributed.publish permission
+PUBLISH_USERS = getattr(settings, 'DISTRIBUTED_PUBLISH_USERS', ())
+
+
+
+def get_published_models():
+    """ {resource name: 'app_label.Model'} of the published models """
+    if PUBLISHED_MODELS is not None:
+        return PUBLISHED_MODELS
+    return getattr(settings, 'DISTRIBUTED_MODELS', {})
+
+
+
+def get_published_model(resource):
+    """ Return the model class published as resource, or None """
+    path = get_published_models().get(resource, None)
+    if not path:
+        return None
+    path = path.split('.')
+    return models.get_model('.'.join(path[:-1]), path[-1])
+
+
+
+def can_read_published(user):
+    """ Whether user may read the published models - deleted rows and digests included """
+    return user.is_active and (user.has_perm('distributed.publish') or user.get_username() in PUBLISH_USERS)
+
+
+
+def basic_auth_required(view):
+    """
+    Let logged in users through, and active users authenticating with HTTP basic auth -
+    the api_username / api_password a DistributedSource sends. Either must be allowed to
+    read the published models, see can_read_published().
+    """
+    @wraps(view)
+    def wrapper(request, *args, **kwargs):
+        user = getattr(request, 'user', None)
+        if user is None or not user.is_authenticated():
+            user = None
+            auth = request.META.get('HTTP_AUTHORIZATION', '').split(None, 1)
+            if len(auth) == 2 and auth[0].lower() == 'basic':
+                try:
+                    username, password = base64.b64decode(auth[1]).split(':', 1)
+                except (TypeError, ValueError):
+                    pass
+                else:
+                    user = authenticate(username=username, password=password)
+            if user is None or not user.is_active:
+                response = HttpResponse('Authentication required', status=401)
+                response['WWW-Authenticate'] = 'Basic realm="distributed"'
+                return response
+            request.user = user
+        if not can_read_published(user):
+            return HttpResponseForbidden('Not allowed to read the published models')
+        return view(request, *args, **kwargs)
+    return wrapper
+
+
+
+def published_rows(model_class, names, since=None, after_uuid=None, limit=PUBLISH_PAGE_SIZE, uuid_range=(None, None)):
+    """
+    values() rows of model_class, deleted ones included, in (modified_date, uuid) order
+    from the keyset position (since, after_uuid) on - up to limit rows. Deletes and
+    undeletes bump modified_date (see models.deleted_values), so they are part of every
+    incremental pull. Rows deleted with a plain update() are only caught by
+    DistributedSourceModel.reconcile(). Without since, rows without a modified_date
+    come first, in uuid order. Models without a modified_date field are paged on uuid
+    alone. uuid_range limits the rows to lowest <= uuid < highest, either end may be None.
+    """
+    queryset = model_class.objects.all_with_deleted()
+    if uuid_range[0]:
+        queryset = queryset.filter(uuid__gte=uuid_range[0])
+    if uuid_range[1]:
+        queryset = queryset.filter(uuid__lt=uuid_range[1])
+    if 'modified_date' not in [field.name for field in model_class._meta.fields]:
+        if after_uuid:
+            queryset = queryset.filter(uuid__gt=after_uuid)
+        return list(queryset.order_by('uuid').values(*names)[:limit])
+    rows = []
+    if since is None:
+        undated = queryset.filter(modified_date__isnull=True)
+        if after_uuid:
+            undated = undated.filter(uuid__gt=after_uuid)
+        rows = list(undated.order_by('uuid').values(*names)[:limit])
+        if len(rows) >= limit:
+            return rows
+        queryset = queryset.filter(modified_date__isnull=False)
+    elif after_uuid:
+        queryset = queryset.filter(Q(modified_date__gt=since) | Q(modified_date=since, uuid__gt=after_uuid))
+    else:
+        # the peer drops the records it already has at exactly since
+        queryset = queryset.filter(modified_date__gte=since)
+    return rows + list(queryset.order_by('modified_date', 'uuid').values(*names)[:limit - len(rows)])
+
+
+
+def index_etag(request):
+    return hashlib.sha1(repr(sorted(get_published_models().keys()))).hexdigest()
+
+
+
+def get_resource_validators(request, resource):
+    """
+    (ETag, last modified) of a published resource as a whole - the same for every page
+    and keyset position, but not wire format. They change when a row is added,
+    modified, deleted or undeleted. Models without a modified_date field have none.
+    """
+    validators = getattr(request, '_distributed_validators', None)
+    if validators is None:
+        validators = (None, None)
+        model_class = get_published_model(resource)
+        if model_class is not None and 'modified_date' in [field.name for field in model_class._meta.fields]:
+            queryset = model_class.objects.all_with_deleted()
+            state = queryset.aggregate(modified=Max('modified_date'), deleted=Max('date_deleted'),
+                                       deleted_count=Count('date_deleted'))
+            state['undated_count'] = queryset.filter(modified_date__isnull=True).count()
+            last_modified = max([value for value in (state['modified'], state['deleted']) if value] or [None])
+            wire_format = negotiate_format(request.META.get('HTTP_ACCEPT'))
+            etag = hashlib.sha1(repr((resource, wire_format, sorted(state.items())))).hexdigest()
+            validators = (etag, last_modified)
+        request._distributed_validators = validators
+    return validators
+
+
+
+def resource_etag(request, resource):
+    return get_resource_validators(request, resource)[0]
+
+
+
+def resource_last_modified(request, resource):
+    return get_resource_validators(request, resource)[1]
+
+
+
+@basic_auth_required
+@condition(etag_func=index_etag)
+def index(request):
+    """ The resource index DistributedSource.sync() reads: {resource name: url} """
+    data = dict((resource, request.build_absolute_uri(reverse('distributed-resource', args=[resource])))
+                for resource in get_published_models().keys())
+    return HttpResponse(json.dumps(data), content_type='application/json')
+
+
+
+@basic_auth_required
+@condition(etag_func=resource_etag, last_modified_func=resource_last_modified)
+def resource(request, resource):
+    """
+    One page of a published model, streamed. The format is negotiated on the Accept
+    header: JSON as {"results": [...], "next": url}, or NDJSON / MessagePack as a
+    stream of records with the next page in a Link header. Query parameters:
+    modified_since and after_uuid (the keyset position, see published_rows), limit,
+    and uuid_gte / uuid_lt for one shard of a sharded sync. There is no next page
+    after the last one. Conditional requests are answered from
+    the validators of the whole resource, see get_resource_validators().
+    """
+    model_class = get_published_model(resource)
+    if model_class is None:
+        raise Http404('Resource %s is not published' % resource)
+    try:
+        limit = min(max(int(request.GET.get('limit', PUBLISH_PAGE_SIZE)), 1), PUBLISH_MAX_PAGE_SIZE)
+        since = request.GET.get('modified_since') or None
+        if since is not None:
+            since = json_to_datetime(since)
+        after_uuid = uuid_hex(request.GET.get('after_uuid')) or None
+        uuid_range = (uuid_hex(request.GET.get('uuid_gte')) or None, uuid_hex(request.GET.get('uuid_lt')) or None)
+    except (AttributeError, TypeError, ValueError):
+        return HttpResponseBadRequest('Invalid limit, modified_since, after_uuid, uuid_gte or uuid_lt')
+    wire_format = negotiate_format(request.META.get('HTTP_ACCEPT'))
+    plan = get_serialize_plan(model_class, typed=(wire_format == 'msgpack'))
+    rows = published_rows(model_class, plan[0], since, after_uuid, limit, uuid_range)
+    next_url = None
+    if len(rows) >= limit:
+        last = rows[-1]
+        params = {'after_uuid': uuid_hex(last['uuid'])}
+        if last.get('modified_date') is not None:
+            params['modified_since'] = last['modified_date'].isoformat()
+        if 'limit' in request.GET:
+            params['limit'] = limit
+        for name, value in zip(('uuid_gte', 'uuid_lt'), uuid_range):
+            if value:
+                params[name] = value
+        next_url = request.build_absolute_uri(request.path) + '?' + urlencode(params)
+
+    def stream_json():
+        yield '{"results": ['
+        separator = ''
+        for chunk in chunked(rows, 100):
+            yield separator + ','.join(json.dumps(serialize_values(row, plan)) for row in chunk)
+            separator = ','
+        yield '], "next": %s}' % json.dumps(next_url)
+
+    def stream_ndjson():
+        for chunk in chunked(rows, 100):
+            yield ''.join(json.dumps(serialize_values(row, plan)) + '\n' for row in chunk)
+
+    def stream_msgpack():
+        packer = msgpack.Packer(use_bin_type=True, default=msgpack_default)
+        for chunk in chunked(rows, 100):
+            yield ''.join(packer.pack(serialize_values(row, plan)) for row in chunk)
+
+    stream = {'json': stream_json, 'ndjson': stream_ndjson, 'msgpack': stream_msgpack}[wire_format]
+    response = StreamingHttpResponse(stream(), content_type=WIRE_CONTENT_TYPES[wire_format])
+    if next_url and wire_format != 'json':
+        response['Link'] = '<%s>; rel="next"' % next_url
+    patch_vary_headers(response, ('Accept',))
+    return response
+
+
+
+@basic_auth_required
+def digest(request, resource):
+    """
+    What DistributedSourceModel.reconcile() compares: the bucket_digests() of the rows
+    whose uuid starts with the hex ?prefix=, as {"buckets": {prefix: [count, digest]}},
+    or with ?rows=1 their reconcile_row()s as {"rows": [[uuid, modified, deleted], ...]}.
+    """
+    model_class = get_published_model(resource)
+    if model_class is None:
+        raise Http404('Resource %s is not published' % resource)
+    prefix = request.GET.get('prefix', '').lower()
+    if len(prefix) > 32 or prefix.strip('0123456789abcdef'):
+        return HttpResponseBadRequest('Invalid prefix')
+    if request.GET.get('rows'):
+        data = {'rows': list(model_class.objects.reconcile_rows(prefix))}
+    else:
+        data = {'buckets': model_class.objects.bucket_digests(prefix)}
+    return HttpResponse(json.dumps(data), content_type='application/json')
+
+
+
+@csrf_exempt
+@require_POST
+def push(request, source_id, resource):
+    """
+    Records pushed by a peer (see DistributedSource.push_changes) as {"results": [...]},
+    for the active DistributedSourceModel resource of DistributedSource source_id. The
+    X-Distributed-Signature header must be the push_signature() of the body with that
+    source's push_secret. Answers {"written": n, "skipped": n}, see apply_push().
+    """
+    source = get_object_or_404(DistributedSource, pk=source_id, active=True)
+    signature = request.META.get('HTTP_X_DISTRIBUTED_SIGNATURE', '')
+    if not source.push_secret or not constant_time_compare(signature, push_signature(source.push_secret, request.body)):
+        return HttpResponseForbidden('Invalid signature')
+    source_model = get_object_or_404(DistributedSourceModel, source=source, resource_name=resource, active=True)
+    try:
+        records = json.loads(request.body)['results']
+    except (KeyError, TypeError, ValueError):
+        return HttpResponseBadRequest('Expected {"results": [...]}')
+    written, skipped = source_model.apply_push(records)
+    return HttpResponse(json.dumps({'written': written, 'skipped': skipped}), content_type='application/json')